@@ -7,8 +7,10 @@ Created on Thu Nov 2017
 This module contains calculation routines for pre/post processing.
 """
 import numpy
+import os
 from scipy import ndimage
 from scipy import signal
+from scipy import optimize
 import transforms3d
 import scipy.ndimage.interpolation as interp
 
@@ -840,24 +842,35 @@ def norm(array, type = 'L2'):
     """
     return numpy.sqrt(numpy.mean((array)**2))    
     
-def _modifier_l2cost_(projections, geometry, subsample, value, key = 'axs_hrz', display = False):
+def _gradient_l2_(vol):
+    '''
+    Sum of squared in-plane gradients of all slices of the volume.
+    '''
+    grad = numpy.gradient(vol, axis = (1, 2))
+    
+    return numpy.sum(grad[0] ** 2) + numpy.sum(grad[1] ** 2)
+    
+def _modifier_l2cost_(projections, geometry, subsample, value, key = 'axs_hrz', display = False, filtered = None):
     '''
     Cost function based on L2 norm of the first derivative of the volume. Computation of the first derivative is done by FDK with pre-initialized reconstruction filter.
+    If filtered ([projections, geometry] returned by fdk_filter) is given, only the backprojection is computed.
     '''
     geometry_ = geometry.copy()
     
     geometry_[key] = value
 
-    vol = flexProject.sample_FDK(projections, geometry_, subsample)
-
-    l2 = 0
-    
-    for ii in range(vol.shape[0]):
-        grad = numpy.gradient(numpy.squeeze(vol[ii, :, :]))
+    if filtered is None:
+        vol = flexProject.sample_FDK(projections, geometry_, subsample)
         
-        grad = (grad[0] ** 2 + grad[1] ** 2)         
+    else:
+        vol = flexProject.init_volume(projections, geometry_)
+        
+        geometry_f = filtered[1].copy()
+        geometry_f[key] = value
         
-        l2 += numpy.sum(grad)
+        flexProject.FDK(filtered[0], vol, geometry_f, filtered = True)
+
+    l2 = _gradient_l2_(vol)
         
     if display:
         flexUtil.display_slice(vol, title = 'Guess = %0.2e, L2 = %0.2e'% (value, l2))    
@@ -875,9 +888,15 @@ def _optimize_modifier_subsample_(values, projections, geometry, samp = [1, 1],
     
     print('Starting a full search from: %0.3f mm' % values.min(), 'to %0.3f mm'% values.max())
     
+    # Weighting and filtering of FDK don't depend on the rotation axis - filter once:
+    geometry_ = geometry.copy()
+    geometry_['sample'] = samp
+    
+    filtered = flexProject.fdk_filter(projections, geometry_)
+    
     ii = 0
     for val in values:
-        func_values[ii] = _modifier_l2cost_(projections, geometry, samp, val, 'axs_hrz', display)
+        func_values[ii] = _modifier_l2cost_(projections, geometry, samp, val, 'axs_hrz', display, filtered)
 
         ii += 1          
     
@@ -885,18 +904,235 @@ def _optimize_modifier_subsample_(values, projections, geometry, samp = [1, 1],
     
     return _parabolic_min_(func_values, min_index, values)  
         
-def optimize_rotation_center(projections, geometry, guess = None, subscale = 1, centre_of_mass = True):
+def _golden_search_(cost, a, b, tol):
+    '''
+    Golden-section search for the minimum of cost in [a, b]. Stops when the interval is shorter than tol.
+    '''
+    ratio = (numpy.sqrt(5) - 1) / 2
+    
+    c = b - ratio * (b - a)
+    d = a + ratio * (b - a)
+    
+    fc = cost(c)
+    fd = cost(d)
+    
+    while abs(b - a) > tol:
+        
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - ratio * (b - a)
+            fc = cost(c)
+            
+        else:
+            a, c, fc = c, d, fd
+            d = a + ratio * (b - a)
+            fd = cost(d)
+            
+    return (a + b) / 2
+    
+def _column_shift_(geometry, cols, subscale):
+    '''
+    Offset (in mm) of the centre of every subscale-th of cols detector columns from the detector centre.
+    Geometries with sample[2] = subscale need it added to det_hrz.
+    '''
+    return ((cols - 1) // subscale * subscale - (cols - 1)) / 2 * geometry['det_pixel']
+    
+def _optimize_centre_slab_(projections, geometry, guess, subscale, slices = 16, threads = None):
+    '''
+    Find the rotation axis using a thin slab of central slices reconstructed from subsampled, pre-filtered projections.
+    A grid of 5 trials is evaluated in parallel (and moved until it brackets the minimum), the minimum is refined by golden-section search.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    
+    img_pix = geometry['img_pixel']
+    threads = threads or os.cpu_count()
+    
+    # Workers of the CPU backend share the cores. ASTRA calls are not thread-safe - trials are evaluated one by one:
+    backend = flexProject.get_backend()
+    
+    if isinstance(backend, flexProject.CPUBackend):
+        workers = min(5, threads)
+        backend_pool = flexProject.CPUBackend(max(threads // workers, 1), backend.slab)
+        
+    else:
+        workers = 1
+        backend_pool = backend
+    
+    # Subsampled geometry:
+    geometry_ = geometry.copy()
+    geometry_['sample'] = [1, subscale, subscale]
+    geometry_['anisotropy'] = [1, subscale, subscale]
+    
+    # Thin slab in the middle of the standard volume, only the detector rows that see it are filtered:
+    shape = flexProject.init_volume(projections, geometry).shape
+    box = [[-slices / 2 * img_pix, slices / 2 * img_pix], [-shape[1] / 2 * img_pix, shape[1] / 2 * img_pix], [-shape[2] / 2 * img_pix, shape[2] / 2 * img_pix]]
+    
+    projections_, geometry_, shape = flexProject.roi_geometry(projections, geometry_, box, columns = False)
+    
+    geometry_['det_hrz'] += _column_shift_(geometry, projections_.shape[2], subscale)
+    
+    filtered, geometry_ = flexProject.fdk_filter(projections_, geometry_, threads = threads)
+    
+    # Cost evaluations are cached:
+    cache = {}
+    
+    def cost(value, backend = backend):
+        
+        if value not in cache:
+            
+            vol = numpy.zeros(shape, dtype = 'float32')
+            
+            geometry_v = geometry_.copy()
+            geometry_v['axs_hrz'] = value
+            
+            with flexProject.ProjectorSession(backend) as session:
+                flexProject.backproject(filtered, vol, geometry_v, 'FDK_FILTERED', session = session)
+            
+            cache[value] = -_gradient_l2_(vol)
+            
+        return cache[value]
+    
+    step = img_pix * subscale / 2
+    values = guess + numpy.arange(-2, 3) * step
+    
+    with ThreadPoolExecutor(workers) as executor:
+        
+        # Move the grid until the minimum is inside:
+        for ii in range(10):
+            
+            costs = list(executor.map(lambda value: cost(value, backend_pool), values))
+            index = int(numpy.argmin(costs))
+            
+            if 0 < index < values.size - 1: break
+            
+            values = values + (index - 2) * step
+            
+    if not 0 < index < values.size - 1:
+        print('WARNING! The minimum is not bracketed after 10 shifts of the grid, the best trial is used: %0.3f mm' % values[index])
+        return values[index]
+            
+    a = values[index - 1]
+    b = values[index + 1]
+    
+    print('Bracket: %0.3f - %0.3f mm' % (a, b))
+    
+    return _golden_search_(cost, a, b, step / 8)
+        
+def _opposing_pairs_(geometry, theta_count):
+    """
+    Find pairs of projection indexes that are 180 degrees apart (within half of the angular step).
+    """
+    if geometry.get('_thetas_') is not None:
+        thetas = numpy.asarray(geometry['_thetas_'], dtype = 'float64')
+        
+    else:
+        thetas = numpy.linspace(geometry.get('theta_min'), geometry.get('theta_max'), theta_count)
+    
+    if thetas.size < 2: return numpy.zeros((0, 2), dtype = 'int64')
+    
+    # Nearest neighbour of every theta + 180 on a circle:
+    angles = thetas % 360
+    order = numpy.argsort(angles)
+    angles = angles[order]
+    
+    target = (thetas + 180) % 360
+    
+    right = numpy.searchsorted(angles, target) % angles.size
+    left = (right - 1) % angles.size
+    
+    dist = lambda k: numpy.abs((angles[k] - target + 180) % 360 - 180)
+    
+    nearest = numpy.where(dist(left) < dist(right), left, right)
+    
+    tolerance = numpy.median(numpy.abs(numpy.diff(thetas))) / 2
+    
+    # Keep each pair once:
+    first = numpy.arange(thetas.size)
+    second = order[nearest]
+    
+    valid = (dist(nearest) <= tolerance) & (first < second)
+    
+    return numpy.stack([first[valid], second[valid]], axis = 1)
+    
+def estimate_rotation_center(projections, geometry, rows = 8, batch = 64):
+    """
+    Estimate the rotation axis shift without reconstruction. Projections 180 degrees apart are mirror images
+    of each other around the projection of the rotation axis. One projection of each pair is flipped and
+    cross-correlated with the other using FFT. Only a few central rows are used.
+    
+    Args:
+        projections : projection data (rows, angles, columns)
+        geometry    : geometry description
+        rows        : number of central rows (cone beam is close to the fan beam there)
+        batch       : number of pairs correlated at once
+        
+    Returns:
+        float: estimate of axs_hrz in mm or None if the scan has no opposing projections
+    """
+    pairs = _opposing_pairs_(geometry, projections.shape[1])
+    
+    if pairs.shape[0] == 0:
+        print('No projections 180 degrees apart are found.')
+        return None
+    
+    print('Correlating %u pairs of opposing projections...' % pairs.shape[0])
+    
+    sample = geometry.get('sample', [1, 1, 1])
+    
+    # The central plane crosses the detector at the height of the source:
+    centre = (projections.shape[0] - 1) / 2 + (geometry['src_vrt'] - geometry['det_vrt']) / (geometry['det_pixel'] * sample[0])
+    first = int(numpy.clip(round(centre - rows / 2), 0, max(projections.shape[0] - rows, 0)))
+    
+    lines = numpy.mean(projections[first:first + rows], axis = 0, dtype = 'float32')
+    
+    # Edges are correlated, not intensities - the background and the object's width would bias the peak towards zero:
+    edges = numpy.gradient(lines, axis = 1)
+    edges_flip = numpy.gradient(lines[:, ::-1], axis = 1)
+    
+    cols = lines.shape[1]
+    n = 2 * cols
+    
+    corr = numpy.zeros(n, dtype = 'float64')
+    
+    for start in range(0, pairs.shape[0], batch):
+        
+        a = edges[pairs[start:start + batch, 0]]
+        b = edges_flip[pairs[start:start + batch, 1]]
+        
+        spectrum = numpy.fft.rfft(a, n = n, axis = 1) * numpy.conj(numpy.fft.rfft(b, n = n, axis = 1))
+        
+        corr += numpy.fft.irfft(spectrum.sum(0), n = n)
+    
+    # Shift of the flipped projection is twice the distance to the centre:
+    corr = numpy.fft.fftshift(corr)
+    shifts = numpy.arange(n) - cols
+    
+    index = numpy.argmax(corr)
+    u0 = _parabolic_min_(corr, index, shifts) / 2 * geometry['det_pixel'] * sample[2]
+    
+    # Position of the axis projection on the detector -> axis shift:
+    m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
+    
+    return (u0 + geometry['det_hrz'] - geometry['src_hrz'] * (1 - m)) / m
+    
+def optimize_rotation_center(projections, geometry, guess = None, subscale = 1, centre_of_mass = True, slices = None, threads = None):
     '''
     Find a center of rotation. If you can, use the center_of_mass option to get the initial guess.
+    The guess is then estimated from opposing projections (see estimate_rotation_center), centre of mass is used if there are none.
     If that fails - use a subscale larger than the potential deviation from the center. Usually, 8 or 16 works fine!
+    If slices is given, a fast search is used: only a slab of that many central slices is reconstructed from pre-filtered data,
+    trials are evaluated by several threads and refined by golden-section search.
     '''
-    
     # Usually a good initial guess is the center of mass of the projection data:
     if  guess is None:  
         if centre_of_mass:
             
-            print('Computing centre of mass...')
-            guess = flexData.pixel2mm(centre(projections)[2], geometry)
+            # Opposing projections give a better estimate, centre of mass is used if there are none:
+            guess = estimate_rotation_center(projections, geometry)
+            
+            if guess is None:
+                print('Computing centre of mass...')
+                guess = flexData.pixel2mm(centre(projections)[2], geometry)
         
         else:
         
@@ -917,10 +1153,14 @@ def optimize_rotation_center(projections, geometry, guess = None, subscale = 1,
         # We will use constant subscale in the vertical direction but vary the horizontal subscale:
         samp =  [20, subscale, subscale]
 
-        # Create a search space of 5 values around the initial guess:
-        trial_values = numpy.linspace(guess - img_pix * subscale, guess + img_pix * subscale, 5)
-        
-        guess = _optimize_modifier_subsample_(trial_values, projections, geometry, samp, key = 'axs_hrz', display = False)
+        if slices:
+            guess = _optimize_centre_slab_(projections, geometry, guess, subscale, slices, threads)
+            
+        else:
+            # Create a search space of 5 values around the initial guess:
+            trial_values = numpy.linspace(guess - img_pix * subscale, guess + img_pix * subscale, 5)
+            
+            guess = _optimize_modifier_subsample_(trial_values, projections, geometry, samp, key = 'axs_hrz', display = False)
                 
         print('Current guess is %0.3f mm' % guess)
         
@@ -928,13 +1168,153 @@ def optimize_rotation_center(projections, geometry, guess = None, subscale = 1,
     
     return guess
 
+def _calibration_step_(key, geometry, shape, subscale):
+    """
+    Initial step of a geometry parameter: one voxel of the subsampled volume at the edge of the volume.
+    """
+    voxel = geometry['img_pixel'] * subscale
+    
+    # Angles (radians) that move the edge of the volume by one voxel:
+    if key == 'det_rot':
+        return 2 / max(shape[0], shape[2]) * subscale
+    
+    # Shifts of the source or detector are demagnified:
+    m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
+    
+    if key in ['det_hrz', 'det_vrt', 'det_mag']:
+        return voxel * m
+    
+    if key in ['src_hrz', 'src_vrt', 'src_mag']:
+        return voxel * m / (m - 1)
+        
+    return voxel
+    
+def calibrate_geometry(projections, geometry, keys = ['axs_hrz'], subscales = [4, 2, 1], slices = 8, slabs = 3, refilter = False, tolerance = 0.05, threads = None):
+    """
+    Refine several geometry parameters together (e.g. axs_hrz, det_rot, src_vrt, det_vrt). The sharpness of a few thin
+    slabs of the reconstruction is maximized by the Nelder-Mead simplex method on subsampled data, coarse to fine.
+    Cost evaluations are cached. Projections are filtered once per subsampling level. Shifts of the source or detector 
+    and det_rot also change the FDK weights - that is ignored unless refilter is True (filtering at every evaluation).
+    
+    Parameters are found to about tolerance steps of the finest level (s = subscales[-1], m is the magnification):
+    axs_hrz - tolerance * s * img_pixel mm, det_hrz / det_vrt / det_mag - the same times m, src_hrz / src_vrt / src_mag - 
+    the same times m / (m - 1), det_rot - tolerance * s * 2 / (volume size in voxels) rad. Vertical shifts (det_vrt, src_vrt) 
+    change the sharpness of the slabs very little and are determined much worse than that.
+    
+    Args:
+        projections : projection data
+        geometry    : initial geometry
+        keys        : geometry keys to refine
+        subscales   : subsampling factors of the coarse-to-fine refinement
+        slices      : thickness of the slabs in slices
+        slabs       : number of slabs distributed along the height of the volume (det_rot and vertical shifts need more than one)
+        refilter    : recompute FDK weights and filtering for every evaluation
+        tolerance   : size of the final simplex in steps of the finest level (coarser levels stop at 0.25 step)
+        threads     : number of threads of FFT
+    
+    Returns:
+        geometry: refined geometry
+    """
+    geometry = geometry.copy()
+    
+    shape = flexProject.init_volume(projections, geometry).shape
+    img_pix = geometry['img_pixel']
+    
+    # Height of the slabs relative to the centre of the volume:
+    height = shape[0] * img_pix / 2 - slices * img_pix
+    heights = numpy.linspace(-0.6, 0.6, slabs) * height if slabs > 1 else [0]
+    
+    # Parameters are found as offsets from the initial geometry:
+    origin = numpy.array([geometry[key] for key in keys], dtype = 'float64')
+    
+    # Number of reconstructions at all levels:
+    total = 0
+    
+    for subscale in subscales:
+        
+        print('Subscale factor %1d' % subscale)    
+        
+        geometry_ = geometry.copy()
+        geometry_['sample'] = [1, subscale, subscale]
+        geometry_['anisotropy'] = [1, subscale, subscale]
+        
+        if not refilter:
+            filtered, geometry_f = flexProject.fdk_filter(projections, geometry_, threads = threads)
+        
+        steps = numpy.array([_calibration_step_(key, geometry, shape, subscale) for key in keys])
+        
+        # Subsampled columns are off the detector centre:
+        shift = _column_shift_(geometry, projections.shape[2], subscale)
+        
+        # Cache is keyed on the parameter values (in steps of this level):
+        cache = {}
+        
+        def cost(x):
+            
+            index = tuple(numpy.round(x, 3))
+            
+            if index not in cache:
+                
+                values = numpy.array([geometry[key] for key in keys]) + x * steps
+                
+                if refilter:
+                    geometry_v = geometry_.copy()
+                    geometry_v.update(zip(keys, values))
+                    
+                    data, geometry_v = flexProject.fdk_filter(projections, geometry_v, threads = threads)
+                    
+                else:
+                    data, geometry_v = filtered, geometry_f.copy()
+                    geometry_v.update(zip(keys, values))
+                
+                # Sharpness of the slabs:
+                value = 0
+                for h in heights:
+                    
+                    vol = numpy.zeros((slices, shape[1] // subscale, shape[2] // subscale), dtype = 'float32')
+                    
+                    geometry_h = geometry_v.copy()
+                    geometry_h['vol_tra'] = numpy.array(geometry_v['vol_tra'], dtype = 'float64') + [h, 0, 0]
+                    geometry_h['det_hrz'] = geometry_v['det_hrz'] + shift
+                    
+                    flexProject.backproject(data, vol, geometry_h, 'FDK_FILTERED')
+                    
+                    value -= _gradient_l2_(vol)
+                    
+                cache[index] = value
+                
+            return cache[index]
+        
+        # Simplex of one step along every parameter:
+        x0 = numpy.zeros(len(keys))
+        simplex = numpy.vstack([x0, numpy.eye(len(keys))])
+        
+        # Coarse levels only need to bring the next level close:
+        xatol = tolerance if subscale == subscales[-1] else 0.25
+        
+        result = optimize.minimize(cost, x0, method = 'Nelder-Mead', options = {'initial_simplex':simplex, 'xatol':xatol, 'fatol':numpy.inf, 'maxfev':50 * len(keys)})
+        
+        for key, value in zip(keys, numpy.array([geometry[key] for key in keys]) + result.x * steps):
+            geometry[key] = value
+            
+        print('Current values:', ', '.join('%s = %0.4f' % (key, geometry[key]) for key in keys), '(%u reconstructions)' % len(cache))
+        
+        total += len(cache)
+    
+    print('Total number of reconstructions: %u' % total)
+    print('Change of parameters:', ', '.join('%s: %0.4f' % (key, geometry[key] - o) for key, o in zip(keys, origin)))
+        
+    return geometry
+    
 def process_flex(path, options = {'bin':1, 'memmap': None}):
     '''
     Read and process the data.
     
     Args:
         path:  path to the flexray data
-        options: dictionary of options, such as bin (binning), memmap (use memmap to save RAM)
+        options: dictionary of options, such as bin (binning), memmap (use memmap to save RAM), threads (number of decoding threads),
+                 stream (apply flat-field correction and log to each image as it is read and write it once in ASTRA order),
+                 astra (read images directly in ASTRA order instead of returning a transposed view)
         
     Return:
         proj: min-log projections
@@ -944,40 +1324,85 @@ def process_flex(path, options = {'bin':1, 'memmap': None}):
     
     bins = options.get('bin')
     memmap = options.get('memmap')
+    stream = options.get('stream')
+    astra = options.get('astra')
     
     skip = options.get('skip')
     if skip is None:
         skip = bins
+        
+    threads = options.get('threads')
+    if threads is None:
+        threads = 1
     
     # Read:    
     print('Reading...')
     
-    dark = flexData.read_raw(path, 'di', sample = [bins, bins])
-    flat = flexData.read_raw(path, 'io', sample = [bins, bins])    
+    # Binning is applied while reading to reduce memory footprint and keep the photon statistics:
+    dark = flexData.read_raw(path, 'di', binning = bins, threads = threads)
+    flat = flexData.read_raw(path, 'io', binning = bins, threads = threads)    
     
-    index = []
-    proj = flexData.read_raw(path, 'scan_', skip = skip, sample = [bins, bins], memmap = memmap, index = index)
-
-    meta = flexData.read_log(path, 'flexray', bins = bins)   
-            
-    # Show fow much memory we have:
-    flexUtil.print_memory()     
-    
-    # Prepro:
-    print('Processing...')
     if dark.ndim > 2:
         dark = dark.mean(0)
         
-    proj -= dark
-    proj /= (flat.mean(0) - dark)
-        
-    numpy.log(proj, out = proj)
-    proj *= -1
+    index = []
     
-    # Fix nans and infs after log:
-    proj[~numpy.isfinite(proj)] = 10
+    if stream:
+        
+        flat = flat.mean(0) - dark
+        
+        # Flat-field and log are applied to each image on the fly, so the stack is written only once:
+        def prepro(image):
+            image = numpy.array(image, dtype = 'float32')
+            
+            image -= dark
+            image /= flat
+            
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+                numpy.log(image, out = image)
+            
+            image *= -1
+            
+            # Fix nans and infs after log:
+            image[~numpy.isfinite(image)] = 10
+            
+            return image
+        
+        print('Reading and processing...')
+        proj = flexData.read_raw(path, 'scan_', skip = skip, binning = bins, memmap = memmap, index = index, threads = threads, 
+                                 process = prepro, astra = True)
+        
+        meta = flexData.read_log(path, 'flexray', bins = bins)   
+        
+    else:
+        proj = flexData.read_raw(path, 'scan_', skip = skip, binning = bins, memmap = memmap, index = index, threads = threads, astra = astra)
     
-    proj = flexData.raw2astra(proj)    
+        meta = flexData.read_log(path, 'flexray', bins = bins)   
+                
+        # Show fow much memory we have:
+        flexUtil.print_memory()     
+        
+        # Prepro:
+        print('Processing...')
+        
+        flat = flat.mean(0) - dark
+        
+        # Dark and flat should follow the layout of projections:
+        if astra:
+            dark = dark[::-1, None, :]
+            flat = flat[::-1, None, :]
+            
+        proj -= dark
+        proj /= flat
+            
+        numpy.log(proj, out = proj)
+        proj *= -1
+        
+        # Fix nans and infs after log:
+        proj[~numpy.isfinite(proj)] = 10
+        
+        if not astra:
+            proj = flexData.raw2astra(proj)    
     
     # Here we will also check whether all files were read and if not - modify thetas accordingly:
     index = numpy.array(index)
@@ -1250,7 +1675,18 @@ def calibrate_spectrum(projections, volume, geometry, compound = 'Al', density =
     #import random
 
     # Find the shape of the object:                                                    
-    if threshold:
+    process = None
+    
+    if isinstance(volume, numpy.memmap):
+        # Volume can be larger than RAM - threshold it slab by slab during the forward projection:
+        if threshold is None:
+            import skimage.filters
+            threshold = skimage.filters.threshold_otsu(volume[::4,::4,::4])
+            
+        segmentation = volume
+        process = lambda x: x > threshold
+        
+    elif threshold:
         segmentation = numpy.array(volume > threshold, 'float32')
     else:
         #max_ = numpy.percentile(volume, 99)
@@ -1269,7 +1705,7 @@ def calibrate_spectrum(projections, volume, geometry, compound = 'Al', density =
     
     length = numpy.zeros_like(projections)    
     length = numpy.ascontiguousarray(length)
-    flexProject.forwardproject(length, segmentation, geometry)
+    flexProject.forwardproject(length, segmentation, geometry, process = process)
     
     # Make 1D:
     intensity = numpy.exp(-projections[length > 0] .ravel())
@@ -17,6 +17,7 @@ We can now read/write:
 import numpy
 import os
 import re
+import json
 import imageio
 import astra 
 import transforms3d
@@ -24,6 +25,13 @@ import transforms3d.euler
 
 from . import flexUtil
 
+# File signature of the chunked container:
+_CHUNKED_MAGIC_ = b'FLEXCHNK'
+
+# Memo cache of astra_proj_geom records:
+_PROJ_GEOM_CACHE_ = {}
+_PROJ_GEOM_CACHE_SIZE_ = 256
+
 ''' * Methods * '''
 
 def read_flexray(path):
@@ -49,7 +57,7 @@ def read_flexray(path):
     
     return proj, flat, dark, meta
         
-def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtype = 'float32', memmap = None, index = None):
+def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtype = 'float32', memmap = None, index = None, threads = 1, binning = 1, process = None, astra = False):
     """
     Read tiff files stack and return numpy array.
     
@@ -63,9 +71,13 @@ def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtyp
         dtype (str or numpy.dtype): data type to return
         memmap (str): if provided, return a disk mapped array to save RAM
         index (array): if provided, will output an index array corresponding to succefully read files.
+        threads (int): number of threads decoding files concurrently
+        binning (int or [by, bx]): average blocks of pixels while reading (unlike sample, which drops pixels)
+        process (function): if provided, applied to every image right after it is decoded (e.g. flat-field correction)
+        astra (bool): if True, write images directly in the ASTRA order (vertical, index, horizontal) with the vertical flip of raw2astra
         
     Returns:
-        numpy.array : 3D array with the first dimension representing the image index
+        numpy.array : 3D array with the first dimension representing the image index (or the vertical axis if astra is True)
         
     """  
         
@@ -88,49 +100,45 @@ def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtyp
     if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
     
     # Read the first file:
-    image = _read_tiff_(files[0], sample, x_roi, y_roi)
+    image = _read_tiff_(files[0], sample, x_roi, y_roi, binning)
     sz = numpy.shape(image)
     
     file_n = len(indx)
+    
+    if astra:
+        shape = (sz[0], file_n, sz[1])
+    else:
+        shape = (file_n, sz[0], sz[1])
         
     # Create a mapped array if needed:
     if memmap:
-        data = numpy.memmap(memmap, dtype='float32', mode='w+', shape = (file_n, sz[0], sz[1]))
+        data = numpy.memmap(memmap, dtype='float32', mode='w+', shape = shape)
         
     else:    
-        data = numpy.zeros((file_n, sz[0], sz[1]), dtype = numpy.float32)
+        data = numpy.zeros(shape, dtype = numpy.float32)
     
     # Read all files:  
-    good = []
-    
-    for k, ii in enumerate(indx):
-        #print(ii)
-        #print(files[ii])
-        filename = files[k]
-        
-        try:
-            a = _read_tiff_(filename, sample, x_roi, y_roi)
-            
-            # Summ RGB:    
-            if a.ndim > 2:
-                a = a.mean(2)
-         
-            #flexUtil.display_slice(a)    
-            data[k, :, :] = a
-            good.append(k)
-        
-        except:
-            pass
-            #a = numpy.zeros(data.shape[1:], dtype = numpy.float32)
-            
-        flexUtil.progress_bar((k+1) / (indx.size))
+    good = _read_stack_(files, data, sample, x_roi, y_roi, binning, threads, process, astra)
 
     # Get rid of the corrupted data:
     if len(good) != file_n:
         print('WARNING! %u files are CORRUPTED!'%(file_n - len(good)))
         
         indx = indx[good]
-        data = data[good]
+        
+        if memmap:
+            # Move the good images to the start of the file, close it and cut off the rest:
+            shape = _compact_images_(data, good, astra)
+            
+            del data
+            os.truncate(memmap, int(numpy.prod(shape)) * 4)
+            
+            data = numpy.memmap(memmap, dtype = 'float32', mode = 'r+', shape = shape)
+            
+        elif astra:
+            data = numpy.ascontiguousarray(data[:, good])
+        else:
+            data = data[good]
 
     # Output index:
     if index is not None:
@@ -181,6 +189,187 @@ def write_raw(path, name, data, dim = 1, skip = 1, dtype = None):
         
         flexUtil.progress_bar((ii+1) / file_num)
         
+def write_chunked(filename, data, meta = None, chunks = None, level = 1):
+    """
+    Write a projection stack or a volume into a single file of independently compressed chunks.
+    
+    Args:
+        filename (str): destination file
+        data (numpy.array): 3D array to write (can be a memmap or a view)
+        meta (dict): meta data (e.g. from read_log) to store in the header
+        chunks ([c0, c1, c2]): shape of a single chunk. Default is 32 x 32 x full width
+        level (int): zlib compression level
+    """
+    import zlib
+    import itertools
+    
+    print('Writing chunked data...')
+    
+    # Make path if does not exist:
+    path = os.path.dirname(filename)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    
+    shape = data.shape
+    
+    if chunks is None:
+        chunks = [min(32, shape[0]), min(32, shape[1]), shape[2]]
+    
+    grid = [int(numpy.ceil(shape[ii] / chunks[ii])) for ii in range(3)]
+    
+    offsets = []
+    sizes = []
+    
+    with open(filename, 'wb') as f:
+        
+        # Magic and a placeholder for the position of the header:
+        f.write(_CHUNKED_MAGIC_)
+        f.write(numpy.uint64(0).tobytes())
+        
+        count = numpy.prod(grid)
+        
+        for ii, chunk in enumerate(itertools.product(*[range(g) for g in grid])):
+            
+            sl = tuple(slice(chunk[jj] * chunks[jj], (chunk[jj] + 1) * chunks[jj]) for jj in range(3))
+            
+            buffer = zlib.compress(numpy.ascontiguousarray(data[sl]).tobytes(), level)
+            
+            offsets.append(f.tell())
+            sizes.append(len(buffer))
+            
+            f.write(buffer)
+            
+            flexUtil.progress_bar((ii+1) / count)
+        
+        # Header goes to the end of the file:
+        header = {'shape':list(shape), 'dtype':numpy.dtype(data.dtype).str, 'chunks':list(chunks), 
+                  'offsets':offsets, 'sizes':sizes, 'meta':meta}
+        
+        position = f.tell()
+        f.write(json.dumps(header, default = _json_encode_).encode())
+        
+        f.seek(len(_CHUNKED_MAGIC_))
+        f.write(numpy.uint64(position).tobytes())
+
+def read_chunked_meta(filename):
+    """
+    Read the header of a chunked file.
+    
+    Returns:
+        header (dict): shape, dtype, chunks, position of the chunks and meta data
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(_CHUNKED_MAGIC_)) != _CHUNKED_MAGIC_:
+            raise IOError('Not a chunked flexbox file:', filename)
+            
+        position = numpy.frombuffer(f.read(8), dtype = numpy.uint64)[0]
+        
+        f.seek(int(position))
+        
+        return json.loads(f.read().decode(), object_hook = _json_decode_)
+    
+def read_chunked(filename, index = None, rows = None, memmap = None, threads = 1):
+    """
+    Read a chunked file. Only chunks that contain requested rows and indexes are decompressed.
+    
+    Args:
+        filename (str): source file
+        index (array): indexes along the second dimension (e.g. projection angles) to read, negative values count from the end
+        rows ([r0, r1]): range along the first dimension (e.g. detector rows) to read, same as a slice [r0:r1]
+        memmap (str): if provided, return a disk mapped array to save RAM
+        threads (int): number of threads used for decompression
+        
+    Returns:
+        data (numpy.array): 3D array of shape (rows, index, width)
+        meta (dict): meta data stored in the file
+    """
+    import zlib
+    
+    header = read_chunked_meta(filename)
+    
+    shape = header['shape']
+    chunks = header['chunks']
+    dtype = numpy.dtype(header['dtype'])
+    grid = [int(numpy.ceil(shape[ii] / chunks[ii])) for ii in range(3)]
+    
+    # What do we need to read:
+    if rows is None:
+        rows = [0, shape[0]]
+        
+    r0, r1, _ = slice(rows[0], rows[1]).indices(shape[0])    
+    r1 = max(r0, r1)
+    
+    if index is None:
+        index = numpy.arange(shape[1])
+        
+    # Same semantics as indexing of the second dimension (negative indexes, out of range raises IndexError):
+    index = numpy.atleast_1d(numpy.arange(shape[1], dtype = 'int64')[index])
+    
+    # Create a mapped array if needed:
+    out_shape = (r1 - r0, index.size, shape[2])
+    
+    if memmap:
+        data = numpy.memmap(memmap, dtype = dtype, mode = 'w+', shape = out_shape)
+    else:    
+        data = numpy.zeros(out_shape, dtype = dtype)
+    
+    # List of chunks to read:
+    row_chunks = range(r0 // chunks[0], (r1 - 1) // chunks[0] + 1)
+    col_chunks = numpy.unique(index // chunks[1])
+    
+    todo = [(c0, c1, c2) for c0 in row_chunks for c1 in col_chunks for c2 in range(grid[2])]
+    
+    f = open(filename, 'rb')
+    
+    def read_one(chunk):
+        
+        c0, c1, c2 = chunk
+        number = (c0 * grid[1] + c1) * grid[2] + c2
+        
+        f.seek(header['offsets'][number])
+        buffer = f.read(header['sizes'][number])
+        
+        return buffer
+    
+    def decode_one(chunk, buffer):
+        
+        c0, c1, c2 = chunk
+        
+        # Shape of this chunk (can be smaller at the edges):
+        ch_shape = [min(chunks[ii], shape[ii] - chunk[ii] * chunks[ii]) for ii in range(3)]
+        block = numpy.frombuffer(zlib.decompress(buffer), dtype = dtype).reshape(ch_shape)
+        
+        # Rows of this chunk and their destination:
+        a0 = max(r0, c0 * chunks[0])
+        a1 = min(r1, c0 * chunks[0] + ch_shape[0])
+        
+        # Indexes that fall into this chunk:
+        dst = numpy.where(index // chunks[1] == c1)[0]
+        src = index[dst] - c1 * chunks[1]
+        
+        x0 = c2 * chunks[2]
+        
+        data[a0 - r0:a1 - r0, dst, x0:x0 + ch_shape[2]] = block[a0 - c0 * chunks[0]:a1 - c0 * chunks[0], src, :]
+    
+    try:
+        # Reading is sequential, decompression can be done in parallel:
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            
+            with ThreadPoolExecutor(threads) as executor:
+                jobs = [executor.submit(decode_one, chunk, read_one(chunk)) for chunk in todo]
+                
+                for job in jobs:
+                    job.result()
+        else:
+            for chunk in todo:
+                decode_one(chunk, read_one(chunk))
+                
+    finally:
+        f.close()
+        
+    return data, header['meta']
+        
 def write_tiff(filename, image):
     """
     Write a single image.
@@ -505,6 +694,72 @@ def raw2astra(array):
         
     return array
 
+def raw2astra_copy(array, memmap = None, block = 32):
+    """
+    Convert a given numpy array (sorted: index, hor, vert) to a contiguous ASTRA-compatible projections stack.
+    Unlike raw2astra, the data is copied in small tiles, so it works for memmaps that are larger than RAM.
+    
+    Args:
+        array (numpy.array): raw projections stack
+        memmap (str): if provided, write the output to a disk mapped array
+        block (int): number of images and rows in one tile
+    """
+    print('Transposing data...')
+    
+    n, rows, cols = array.shape
+    shape = (rows, n, cols)
+    
+    if memmap:
+        out = numpy.memmap(memmap, dtype = array.dtype, mode = 'w+', shape = shape)
+    else:
+        out = numpy.zeros(shape, dtype = array.dtype)
+    
+    # Every tile reads a contiguous range of images and writes contiguous runs of rows:
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        
+        for r0 in range(0, rows, block):
+            r1 = min(r0 + block, rows)
+            
+            tile = numpy.array(array[i0:i1, r0:r1, :])
+            
+            # Flip:
+            out[rows - r1:rows - r0, i0:i1, :] = tile.transpose([1, 0, 2])[::-1]
+            
+        flexUtil.progress_bar(i1 / n)
+        
+    return out
+
+def theta_major(array, memmap = None, block = 32):
+    """
+    Store an ASTRA-compatible projections stack angle-major (index, vert, hor) and return an ASTRA-shaped view of it.
+    A block of angles of such a stack is a single contiguous read, which helps iterative methods that read data in blocks from a memmap.
+    
+    Args:
+        array (numpy.array): projections stack in ASTRA order
+        memmap (str): if provided, the data is stored in a disk mapped array
+        block (int): number of angles copied at once
+    """
+    print('Reordering data angle-major...')
+    
+    rows, n, cols = array.shape
+    shape = (n, rows, cols)
+    
+    if memmap:
+        out = numpy.memmap(memmap, dtype = array.dtype, mode = 'w+', shape = shape)
+    else:
+        out = numpy.zeros(shape, dtype = array.dtype)
+        
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        
+        out[i0:i1] = numpy.transpose(array[:, i0:i1, :], [1, 0, 2])
+        
+        flexUtil.progress_bar(i1 / n)
+        
+    # View in ASTRA order:
+    return numpy.transpose(out, [1, 0, 2])
+
 def pixel2mm(value, geometry):
     """
     Convert pixels to millimetres by multiplying the value by img_pixel 
@@ -565,7 +820,7 @@ def astra_vol_geom(geometry, vol_shape, slice_first = None, slice_last = None):
         offset = offset * voxel[0]
         
         shape = [slice_last - slice_first + 1, vol_shape[1], vol_shape[2]]
-        size = shape * voxel[0]
+        size = numpy.array(shape) * voxel
 
     else:
         shape = vol_shape
@@ -580,6 +835,8 @@ def astra_vol_geom(geometry, vol_shape, slice_first = None, slice_last = None):
 def astra_proj_geom(geometry, data_shape, index = None):
     """
     Generate the vector that describes positions of the source and detector.
+    The vectors of all angles are computed in one pass and memoized: repeated
+    calls with the same geometry, data shape and index return a cached copy.
     """
     # Basic geometry:
     det_count_x = data_shape[2]
@@ -602,92 +859,113 @@ def astra_proj_geom(geometry, data_shape, index = None):
         
         thetas = numpy.linspace(geometry.get('theta_min'), geometry.get('theta_max'),theta_count, dtype = 'float32') / 180 * numpy.pi
 
-    # Inintialize ASTRA projection geometry to import vector from it
     if (index is not None):
         
         thetas = thetas[index]
-       
-    proj_geom = astra.creators.create_proj_geom('cone', det_pixel[1], det_pixel[0], det_count_z, det_count_x, thetas, src2obj, det2obj)
+        
+    thetas = numpy.asarray(thetas)    
     
-    proj_geom = astra.functions.geom_2vec(proj_geom)
-      
-    vectors = proj_geom['Vectors']
+    # Look up the memo cache:
+    key = _proj_geom_key_(geometry, det_pixel, det_count_z, det_count_x, thetas)
     
-    # Modify vector and apply it to astra projection geometry:
-    for ii in range(0, vectors.shape[0]):
-
-        # Define vectors:
-        src_vect = vectors[ii, 0:3]    
-        det_vect = vectors[ii, 3:6]    
-        det_axis_hrz = vectors[ii, 6:9]          
-        det_axis_vrt = vectors[ii, 9:12]
-
-        #Precalculate vector perpendicular to the detector plane:
-        det_normal = numpy.cross(det_axis_hrz, det_axis_vrt)
-        det_normal = det_normal / numpy.sqrt(numpy.dot(det_normal, det_normal))
+    proj_geom = _PROJ_GEOM_CACHE_.get(key)
+    
+    if proj_geom is None:
+        
+        vectors = _proj_geom_vectors_(geometry, det_pixel, src2obj, det2obj, thetas)
+        proj_geom = astra.creators.create_proj_geom('cone_vec', det_count_z, det_count_x, vectors)
         
-        # Translations relative to the detecotor plane:
+        # Drop the oldest entry when the cache is full:
+        if len(_PROJ_GEOM_CACHE_) >= _PROJ_GEOM_CACHE_SIZE_:
+            _PROJ_GEOM_CACHE_.pop(next(iter(_PROJ_GEOM_CACHE_)))
+            
+        _PROJ_GEOM_CACHE_[key] = proj_geom
     
-        #Detector shift (V):
-        det_vect += geometry['det_vrt'] * det_axis_vrt / det_pixel[0]
-
-        #Detector shift (H):
-        det_vect += geometry['det_hrz'] * det_axis_hrz / det_pixel[1]
-
-        #Detector shift (M):
-        det_vect += geometry['det_mag'] * det_normal /  det_pixel[1]
-
-        #Source shift (V):
-        src_vect += geometry['src_vrt'] * det_axis_vrt / det_pixel[0]
+    # Callers are free to modify the record they get:
+    proj_geom = proj_geom.copy()
+    proj_geom['Vectors'] = proj_geom['Vectors'].copy()
+    
+    return proj_geom   
 
-        #Source shift (H):
-        src_vect += geometry['src_hrz'] * det_axis_hrz / det_pixel[1]
+def _proj_geom_key_(geometry, det_pixel, det_count_z, det_count_x, thetas):
+    """
+    Hashable key of everything that astra_proj_geom depends on.
+    """
+    values = [geometry[key] for key in ['src2obj', 'det2obj', 'det_vrt', 'det_hrz', 'det_mag', 
+              'src_vrt', 'src_hrz', 'src_mag', 'axs_hrz', 'det_rot']]
+    
+    values += list(numpy.ravel(geometry['vol_rot'])) + list(numpy.ravel(geometry['vol_tra'])) + list(det_pixel)
+    
+    return (tuple(float(v) for v in values), det_count_z, det_count_x, thetas.dtype.str, thetas.tobytes())
 
-        #Source shift (M):
-        src_vect += geometry['src_mag'] * det_normal / det_pixel[1]
+def _proj_geom_vectors_(geometry, det_pixel, src2obj, det2obj, thetas):
+    """
+    Compute the ASTRA cone_vec table for all angles at once.
+    """
+    n = thetas.size
+    sin = numpy.sin(thetas)
+    cos = numpy.cos(thetas)
+    
+    # Circular orbit, same as astra.functions.geom_2vec of a 'cone' geometry:
+    src_vect = numpy.stack([sin * src2obj, -cos * src2obj, numpy.zeros(n)], axis = 1)
+    det_vect = numpy.stack([-sin * det2obj, cos * det2obj, numpy.zeros(n)], axis = 1)
+    det_axis_hrz = numpy.stack([cos * det_pixel[1], sin * det_pixel[1], numpy.zeros(n)], axis = 1)
+    det_axis_vrt = numpy.zeros((n, 3))
+    det_axis_vrt[:, 2] = det_pixel[0]
+    
+    #Precalculate vector perpendicular to the detector plane:
+    det_normal = numpy.cross(det_axis_hrz, det_axis_vrt)
+    det_normal /= numpy.sqrt((det_normal ** 2).sum(1))[:, None]
+    
+    # Translations relative to the detecotor plane:
+    det_vect += geometry['det_vrt'] * det_axis_vrt / det_pixel[0]
+    det_vect += geometry['det_hrz'] * det_axis_hrz / det_pixel[1]
+    det_vect += geometry['det_mag'] * det_normal /  det_pixel[1]
 
-        # Rotation axis shift:
-        det_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
-        src_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
+    src_vect += geometry['src_vrt'] * det_axis_vrt / det_pixel[0]
+    src_vect += geometry['src_hrz'] * det_axis_hrz / det_pixel[1]
+    src_vect += geometry['src_mag'] * det_normal / det_pixel[1]
 
-        # Rotation relative to the detector plane:
-        # Compute rotation matrix
+    # Rotation axis shift:
+    det_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
+    src_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
     
-        T = transforms3d.axangles.axangle2mat(det_normal, geometry['det_rot'])
-        
-        det_axis_hrz[:] = numpy.dot(T.T, det_axis_hrz)
-        det_axis_vrt[:] = numpy.dot(T, det_axis_vrt)
+    # Rotation relative to the detector plane (Rodrigues formula around the normal):
+    det_axis_hrz = _rotate_vectors_(det_axis_hrz, det_normal, -geometry['det_rot'])
+    det_axis_vrt = _rotate_vectors_(det_axis_vrt, det_normal, geometry['det_rot'])
     
-        # Global transformation:
-        # Rotation matrix based on Euler angles:
-        R = transforms3d.euler.euler2mat(geometry['vol_rot'][0], geometry['vol_rot'][1], geometry['vol_rot'][2], 'rzyx')
-
-        # Apply transformation:
-        det_axis_hrz[:] = numpy.dot(det_axis_hrz, R)
-        det_axis_vrt[:] = numpy.dot(det_axis_vrt, R)
-        src_vect[:] = numpy.dot(src_vect,R)
-        det_vect[:] = numpy.dot(det_vect,R)            
-                
-        # Add translation:
-        vect_norm = numpy.sqrt((det_axis_vrt ** 2).sum())
+    # Global transformation:
+    # Rotation matrix based on Euler angles:
+    R = transforms3d.euler.euler2mat(geometry['vol_rot'][0], geometry['vol_rot'][1], geometry['vol_rot'][2], 'rzyx')
 
-        # Take into account that the center of rotation should be in the center of reconstruction volume:        
-        # T = numpy.array([geometry['vol_mag'] * vect_norm / det_pixel[1], geometry['vol_hrz'] * vect_norm / det_pixel[1], geometry['vol_vrt'] * vect_norm / det_pixel[0]])    
-        T = numpy.array([geometry['vol_tra'][1] * vect_norm / det_pixel[1], geometry['vol_tra'][2] * vect_norm / det_pixel[1], geometry['vol_tra'][0] * vect_norm / det_pixel[0]])    
-        
-        src_vect[:] -= numpy.dot(T, R)           
-        det_vect[:] -= numpy.dot(T, R)
-        
-    #print('vol_tra', geometry['vol_tra'])
-    #print('det_pixel', det_pixel)
-    #print('vect_norm', vect_norm)
-    #print('T', T)
+    det_axis_hrz = numpy.dot(det_axis_hrz, R)
+    det_axis_vrt = numpy.dot(det_axis_vrt, R)
+    src_vect = numpy.dot(src_vect, R)
+    det_vect = numpy.dot(det_vect, R)
     
-        
-    proj_geom['Vectors'] = vectors    
+    # Take into account that the center of rotation should be in the center of reconstruction volume:        
+    vect_norm = numpy.sqrt((det_axis_vrt ** 2).sum(1))
     
-    return proj_geom   
+    vol_tra = geometry['vol_tra']
+    T = numpy.stack([vol_tra[1] * vect_norm / det_pixel[1], vol_tra[2] * vect_norm / det_pixel[1], vol_tra[0] * vect_norm / det_pixel[0]], axis = 1)
+    T = numpy.dot(T, R)
+    
+    src_vect -= T
+    det_vect -= T
+    
+    return numpy.concatenate([src_vect, det_vect, det_axis_hrz, det_axis_vrt], axis = 1)
 
+def _rotate_vectors_(vectors, axes, angle):
+    """
+    Rotate each row of vectors around the matching (unit) row of axes.
+    """
+    cos = numpy.cos(angle)
+    sin = numpy.sin(angle)
+    
+    dot = (vectors * axes).sum(1)[:, None]
+    
+    return vectors * cos + numpy.cross(axes, vectors) * sin + axes * dot * (1 - cos)
+    
 def create_geometry(src2obj, det2obj, det_pixel, theta_range):
     """
     Initialize an empty geometry record.
@@ -781,30 +1059,216 @@ def tiles_shape(shape, geometry_list):
 
     return new_shape, geometry
                  
-def _read_tiff_(file, sample = [1, 1], x_roi = [], y_roi = []):
+def _read_tiff_(file, sample = [1, 1], x_roi = [], y_roi = [], binning = 1):
     """
     Read a single image.
     """
+    
+    # Uncompressed striped tiffs allow to read only the strips with the rows we need:
+    im = _read_tiff_strips_(file, y_roi)
+    
+    if im is None:
         
-    # SOmetimes files dont have an extension. Fix it!
-    if os.path.splitext(file)[1] == '':
-        #im = imageio.imread(file, format = 'tif', offset = 0)
-        im = imageio.imread(file, format = 'tif')
-    else:
-        #im = imageio.imread(file, offset = 0)
-        im = imageio.imread(file)
+        # SOmetimes files dont have an extension. Fix it!
+        if os.path.splitext(file)[1] == '':
+            #im = imageio.imread(file, format = 'tif', offset = 0)
+            im = imageio.imread(file, format = 'tif')
+        else:
+            #im = imageio.imread(file, offset = 0)
+            im = imageio.imread(file)
+            
+        if (y_roi != []):
+            im = im[y_roi[0]:y_roi[1], :]
         
-    # TODO: Use kwags offset  and size to apply roi!
-    if (y_roi != []):
-        im = im[y_roi[0]:y_roi[1], :]
     if (x_roi != []):
         im = im[:, x_roi[0]:x_roi[1]]
+        
+    if numpy.any(numpy.array(binning) > 1):
+        im = _bin_image_(im, binning)
 
     if sample != 1:
         im = im[::sample[0], ::sample[1]]
     
     return im
 
+def _read_tiff_strips_(file, y_roi = []):
+    """
+    Read the rows y_roi of an uncompressed striped tiff without touching the other strips.
+    Returns None if the file is compressed, tiled or is not a tiff at all.
+    """
+    try:
+        import tifffile
+        
+        tif = tifffile.TiffFile(file)
+        
+    except:
+        return None
+    
+    with tif:
+        page = tif.pages[0]
+        
+        # Only simple layouts can be read strip by strip:
+        if (page.compression != 1) | page.is_tiled | (page.samplesperpixel != 1) | (page.bitspersample % 8 != 0):
+            return None
+        
+        height = page.imagelength
+        width = page.imagewidth
+        rps = min(page.rowsperstrip, height)
+        
+        # Range of rows and strips that contain them:
+        if y_roi != []:
+            y0, y1, _ = slice(y_roi[0], y_roi[1]).indices(height)
+        else:
+            y0, y1 = 0, height
+            
+        if y1 <= y0:
+            return None
+        
+        s0 = y0 // rps
+        s1 = (y1 - 1) // rps + 1
+        
+        if len(page.dataoffsets) < s1:
+            return None
+        
+        # Read strips:
+        buffer = bytearray()
+        
+        for ii in range(s0, s1):
+            tif.filehandle.seek(page.dataoffsets[ii])
+            buffer += tif.filehandle.read(page.databytecounts[ii])
+        
+        dtype = page.dtype.newbyteorder(tif.byteorder)
+        
+        im = numpy.frombuffer(buffer, dtype = dtype)
+        im = im[:(im.size // width) * width].reshape(-1, width)
+        
+        return im[y0 - s0 * rps:y1 - s0 * rps]
+    
+def _bin_image_(image, binning):
+    """
+    Average blocks of pixels of a 2D image. Remainder rows and columns are discarded.
+    """
+    if numpy.size(binning) > 1:
+        by, bx = binning
+    else:
+        by = bx = binning
+        
+    h = image.shape[0] // by
+    w = image.shape[1] // bx
+    
+    image = image[:h * by, :w * bx].reshape(h, by, w, bx)
+    
+    return image.mean((1, 3), dtype = 'float32')
+
+def _compact_images_(data, good, astra = False):
+    """
+    Move the good images of a stack towards the start of its buffer, one row (or image) at a time, 
+    so that a memmap stack is never loaded in RAM. 
+    
+    Returns:
+        tuple : shape of the stack of good images (it occupies the start of the buffer)
+    """
+    good = numpy.asarray(good)
+    n = good.size
+    
+    if astra:
+        # Rows of the new layout never overlap rows of the old layout that are not copied yet:
+        rows, file_n, cols = data.shape
+        
+        flat = data.reshape(-1)
+        
+        for r in range(rows):
+            flat[r * n * cols:(r + 1) * n * cols] = numpy.array(data[r, good]).ravel()
+            
+        shape = (rows, n, cols)
+            
+    else:
+        for k, j in enumerate(good):
+            if k != j: data[k] = data[j]
+            
+        shape = (n,) + data.shape[1:]
+            
+    data.flush()
+    
+    return shape
+    
+def _read_stack_(files, data, sample = [1, 1], x_roi = [], y_roi = [], binning = 1, threads = 1, process = None, astra = False):
+    """
+    Decode files into their slots of a preallocated array. Several files are decoded at the same time if threads > 1.
+    
+    Returns:
+        list : indexes of the files that were read successfully
+    """
+    
+    def read_one(k):
+        
+        try:
+            a = _read_tiff_(files[k], sample, x_roi, y_roi, binning)
+            
+            # Summ RGB:    
+            if a.ndim > 2:
+                a = a.mean(2)
+                
+            if process is not None:
+                a = process(a)
+            
+            if astra:
+                data[::-1, k, :] = a
+            else:
+                data[k, :, :] = a
+                
+            return True
+        
+        except:
+            return False
+        
+    file_n = len(files)
+    good = []
+    
+    if threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        # Decoding and disk access release the GIL, so threads are sufficient here:
+        executor = ThreadPoolExecutor(threads)
+        status = executor.map(read_one, range(file_n))
+        
+    else:
+        executor = None
+        status = map(read_one, range(file_n))
+    
+    try:    
+        for k, ok in enumerate(status):
+            if ok:
+                good.append(k)
+                
+            flexUtil.progress_bar((k+1) / file_n)
+            
+    finally:
+        if executor: executor.shutdown()
+        
+    return good
+
+def _json_encode_(obj):
+    """
+    Help json to write numpy types.
+    """
+    if isinstance(obj, numpy.ndarray):
+        return {'__ndarray__':obj.tolist(), 'dtype':obj.dtype.str}
+        
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    
+    raise TypeError('Can`t serialize', type(obj))
+    
+def _json_decode_(obj):
+    """
+    Restore numpy arrays written by _json_encode_.
+    """
+    if '__ndarray__' in obj:
+        return numpy.array(obj['__ndarray__'], dtype = obj['dtype'])
+    
+    return obj
+    
 def _get_flexray_keywords_():                  
     """
     Create dictionary needed to read FlexRay log file.
@@ -319,8 +319,14 @@ def forward_spectral(vol, proj, geometry, materials, energy, spectrum, n_phot =
         
         # Forward project:    
         proj_j = numpy.zeros_like(proj)
-        vol_j = numpy.float32(vol == (jj+1))
-        flexProject.forwardproject(proj_j, vol_j, geometry)
+        
+        if isinstance(vol, numpy.memmap):
+            # Label is extracted slab by slab:
+            flexProject.forwardproject(proj_j, vol, geometry, process = lambda x: x == (jj+1))
+            
+        else:
+            vol_j = numpy.float32(vol == (jj+1))
+            flexProject.forwardproject(proj_j, vol_j, geometry)
         
         lab_proj.append(proj_j)
         
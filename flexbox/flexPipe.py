@@ -461,7 +461,7 @@ class Pipe:
     def _read_flexray_(self, data, condition, count):
         """
         Read data from disk.
-        Possible conditions: path, samplig, memmap
+        Possible conditions: path, samplig, memmap, threads, astra
         """        
         
         # Read:    
@@ -472,10 +472,15 @@ class Pipe:
         samp = condition.get('sampling')
         skip = condition.get('skip')
         memmap = condition.get('memmap')
+        threads = condition.get('threads')
+        astra = condition.get('astra')
         
         if skip is None:
             skip = samp
             
+        if threads is None:
+            threads = 1
+            
         if memmap:
             self._memmaps_.append(memmap)
 
@@ -485,14 +490,16 @@ class Pipe:
         data.flat = None
             
         # Read projections:                
-        data.dark = flexData.read_raw(path, 'di', sample = [samp, samp])
-        data.flat = flexData.read_raw(path, 'io', sample = [samp, samp])    
+        data.dark = flexData.read_raw(path, 'di', sample = [samp, samp], threads = threads)
+        data.flat = flexData.read_raw(path, 'io', sample = [samp, samp], threads = threads)    
         
-        data.data = flexData.read_raw(path, 'scan_', skip = skip, sample = [samp, samp], memmap = memmap)
+        data.data = flexData.read_raw(path, 'scan_', skip = skip, sample = [samp, samp], memmap = memmap, threads = threads, astra = astra)
     
         data.meta = flexData.read_log(path, 'flexray', bins = samp)   
-                
-        data.data = flexData.raw2astra(data.data)    
+        
+        # Projections can be read in ASTRA order already:
+        if not astra:
+            data.data = flexData.raw2astra(data.data)    
         data.dark = flexData.raw2astra(data.dark)    
         data.flat = flexData.raw2astra(data.flat)    
         
@@ -720,7 +727,9 @@ class Pipe:
         gc.collect()
     
     def _sirt_(self, data, condition, count):        
-                
+        """
+        Iterative reconstruction. Possible conditions: iterations, method ('sirt' or 'fista')
+        """        
         shape = data.data.shape
         vol = numpy.zeros([shape[0]+40, shape[2], shape[2]], dtype = 'float32')
         
@@ -728,7 +737,12 @@ class Pipe:
         
         iterations = condition.get('iterations')
         
-        flexProject.SIRT(data.data, vol, data.meta['geometry'], iterations = iterations, options = options)
+        # FISTA needs fewer iterations for the same result:
+        if condition.get('method') == 'fista':
+            flexProject.FISTA(data.data, vol, data.meta['geometry'], iterations = iterations, options = options)
+            
+        else:
+            flexProject.SIRT(data.data, vol, data.meta['geometry'], iterations = iterations, options = options)
                 
         # Replace projection data with volume data:
         data.data = vol 
@@ -738,7 +752,14 @@ class Pipe:
         Find the rotation axis:
         """
         print('Optimization of the rotation axis...')
-        guess = flexCompute.optimize_rotation_center(data.data, data.meta['geometry'], centre_of_mass = False, subscale = 4)
+        
+        # Opposing projections give the initial guess, the current value is used if there are none:
+        guess = flexCompute.estimate_rotation_center(data.data, data.meta['geometry'])
+        
+        if guess is None:
+            guess = data.meta['geometry']['axs_hrz']
+        
+        guess = flexCompute.optimize_rotation_center(data.data, data.meta['geometry'], guess = guess, subscale = 4, slices = 16)
         
         print('Old value:%0.3f' % data.meta['geometry']['axs_hrz'], 'new value: %0.3f' % guess)
         data.meta['geometry']['axs_hrz'] = guess
@@ -783,10 +804,21 @@ class Pipe:
         #data.data = flexUtil.apply_edge_ramp(data.data, width, extend)
     
     def _fdk_(self, data, condition, count):        
-
+        """
+        FDK reconstruction.
+        Possible conditions: shape, ramp, em, sirt, memmap (volume file), slab (slices reconstructed at once)
+        """
         shape = condition.get('shape')
+        memmap = condition.get('memmap')
         
-        if shape:
+        if memmap:
+            # Out-of-core volume is reconstructed slab by slab:
+            if not shape: shape = [data.data.shape[0], data.data.shape[2], data.data.shape[2]]
+            
+            vol = numpy.memmap(memmap, dtype = 'float32', mode = 'w+', shape = tuple(shape))
+            self._memmaps_.append(memmap)
+            
+        elif shape:
             vol = numpy.zeros(shape, dtype = 'float32')
             
         else:
@@ -797,7 +829,7 @@ class Pipe:
         if ramp:
             data.data = flexData.pad(data.data, 2, [ramp, ramp], mode = 'linear')
         
-        flexProject.FDK(data.data, vol, data.meta['geometry'])
+        flexProject.FDK(data.data, vol, data.meta['geometry'], slab = condition.get('slab'))
         
         em = condition.get('em')
         sirt = condition.get('sirt')
@@ -890,6 +922,7 @@ class Pipe:
     def _memmap_(self, data, condition, count):
         """
         Map data to disk
+        Possible conditions: path, layout ('theta' stores projections angle-major)
         """
         
         print('Mapping data to disk...')
@@ -901,10 +934,15 @@ class Pipe:
         dtype = data.data.dtype
         
         self._memmaps_.append(file)
-        memmap = numpy.memmap(file, dtype=dtype, mode='w+', shape = (shape[0], shape[1], shape[2]))       
         
-        memmap[:] = data.data[:]
-        data.data = memmap
+        if condition.get('layout') == 'theta':
+            data.data = flexData.theta_major(data.data, file)
+            
+        else:
+            memmap = numpy.memmap(file, dtype=dtype, mode='w+', shape = (shape[0], shape[1], shape[2]))       
+            
+            memmap[:] = data.data[:]
+            data.data = memmap
         
         # Clean up memory
         gc.collect()
@@ -12,14 +12,19 @@ This module some wrappers around ASTRA to make lives of people slightly less hor
 import numpy
 import astra
 import sys
+import os
 import matplotlib.pyplot as plt
 import random
+import contextlib
 import scipy 
 
 from . import flexUtil
 from . import flexData
 from . import flexModel
 
+# Projector backend used by new sessions (see set_backend):
+_BACKEND_ = None
+
 ''' * Methods * '''
 
 def misfit(res, scl, deg):
@@ -55,40 +60,983 @@ def studentst(res, deg = 1, scl = None):
     return grad
 
 
-def _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'BP3D_CUDA', operation = '+'):
+class AstraBackend:
     """
-    Use this internal function to compute backprojection of a single block of data.
-    """           
+    Projector backend that runs ASTRA's cuda3d projector. 
+    A backend exposes: link / delete (data objects), create_projector / delete_projector and accumulate (FP, BP or FDK).
+    """
+    name = 'astra'
     
-    # Unfortunately need to hide the experimental ASTRA
-    import astra.experimental as asex 
+    # FDK_FILTERED backprojects data filtered by fdk_filter:
+    prefilter = True
     
-    try:
+    def link(self, kind, geom, array):
+        return astra.data3d.link(kind, geom, array)
         
-        if (operation == '+'):
-            volume_ = volume
+    def delete(self, data_id):
+        astra.data3d.delete(data_id)
+        
+    def create_projector(self, proj_geom, vol_geom):
+        return astra.create_projector('cuda3d', proj_geom, vol_geom)
+        
+    def delete_projector(self, projector_id):
+        astra.projector3d.delete(projector_id)
+        
+    def accumulate(self, algorithm, projector_id, vol_id, sin_id, bricks = None):
+        
+        # ASTRA always projects the whole volume (bricks are ignored).
+        # Unfortunately need to hide the experimental ASTRA
+        import astra.experimental as asex 
+        
+        if algorithm == 'FP3D_CUDA':
+            asex.accumulate_FP(projector_id, vol_id, sin_id)
             
-        elif (operation == '*') | (operation == '/'):
-            volume_ = numpy.zeros_like(volume)
+        elif algorithm == 'BP3D_CUDA':
+            asex.accumulate_BP(projector_id, vol_id, sin_id)
+            
+        elif algorithm == 'FDK_CUDA':
+            asex.accumulate_FDK(projector_id, vol_id, sin_id)
+            
+        elif algorithm == 'FDK_FILTERED':
+            self._fdk_filtered_(vol_id, sin_id)
             
-        else: ValueError('Unknown operation type!')
+        else:
+            raise ValueError('Unknown ASTRA algorithm type.')
+            
+    def _fdk_filtered_(self, vol_id, sin_id):
+        """
+        FDK backprojection of projections that are already weighted and filtered (see fdk_filter).
+        ASTRA's FDK applies the cosine weighting itself, so it is divided out and the filter is switched off.
+        """
+        proj_geom = astra.data3d.get_geometry(sin_id)
+        vol_geom = astra.data3d.get_geometry(vol_id)
+        
+        projections = astra.data3d.get_shared(sin_id)
+        projections = projections / _fdk_cosine_(proj_geom['Vectors'], proj_geom['DetectorRowCount'], proj_geom['DetectorColCount'])
+        
+        sin_tmp = astra.data3d.link('-sino', proj_geom, numpy.ascontiguousarray(projections, dtype = 'float32'))
+        vol_tmp = astra.data3d.create('-vol', vol_geom, 0)
+        
+        cfg = astra.astra_dict('FDK_CUDA')
+        cfg['ProjectionDataId'] = sin_tmp
+        cfg['ReconstructionDataId'] = vol_tmp
+        cfg['option'] = {'FilterType': 'none'}
+        
+        alg_id = astra.algorithm.create(cfg)
+        
+        try:
+            astra.algorithm.run(alg_id)
+            astra.data3d.get_shared(vol_id)[:] += astra.data3d.get_shared(vol_tmp)
+            
+        finally:
+            astra.algorithm.delete(alg_id)
+            astra.data3d.delete([sin_tmp, vol_tmp])
+
+class CPUBackend:
+    """
+    Multithreaded NumPy cone-beam projector backend. Uses the same cone_vec geometries as AstraBackend.
+    The forward projection is voxel-driven (every voxel is spread over the detector with bilinear weights), 
+    the backprojection is its exact transpose. Scaling follows the conventions of the solvers in this module:
+    FP returns line integrals in mm, BP is the adjoint of FP times voxel_size^2, FDK is multiplied by voxel_size^4.
+    
+    Args:
+        threads : number of threads (number of cores by default)
+        slab    : number of voxels processed at once by a single thread
+    """
+    name = 'cpu'
+    
+    # FDK_FILTERED backprojects data filtered by fdk_filter:
+    prefilter = True
+    
+    def __init__(self, threads = None, slab = 2**20):
         
-        if (operation == '-'):
-            projections *= -1
-                    
-        sin_id = astra.data3d.link('-sino', proj_geom, projections)        
-        vol_id = astra.data3d.link('-vol', vol_geom, volume_)    
+        self.threads = threads or os.cpu_count()
+        self.slab = slab
         
-        projector_id = astra.create_projector('cuda3d', proj_geom, vol_geom)
+        # Data and projector objects (several sessions can share the backend in different threads):
+        from threading import Lock
+        
+        self._objects_ = {}
+        self._count_ = 0
+        self._lock_ = Lock()
     
-        if algorithm == 'BP3D_CUDA':
-            asex.accumulate_BP(projector_id, vol_id, sin_id)
+    def _add_(self, record):
+        
+        with self._lock_:
+            self._count_ += 1
+            self._objects_[self._count_] = record
+        
+            return self._count_
+        
+    def link(self, kind, geom, array):
+        
+        if kind == '-vol':
+            shape = (geom['GridSliceCount'], geom['GridRowCount'], geom['GridColCount'])
+        else:
+            shape = (geom['DetectorRowCount'], geom['Vectors'].shape[0], geom['DetectorColCount'])
+            
+        if tuple(array.shape) != shape:
+            raise ValueError('Data shape %s does not match the geometry %s' % (str(array.shape), str(shape)))
+            
+        return self._add_(array)
+        
+    def delete(self, data_id):
+        self._objects_.pop(data_id)
+        
+    def create_projector(self, proj_geom, vol_geom):
+        return self._add_(_cpu_projector_(proj_geom, vol_geom))
+        
+    def delete_projector(self, projector_id):
+        self._objects_.pop(projector_id)
+        
+    def accumulate(self, algorithm, projector_id, vol_id, sin_id, bricks = None):
+        """
+        Project one block. If bricks (BrickMap of the volume) is given, only active bricks are projected.
+        """
+        projector = self._objects_[projector_id]
+        volume = self._objects_[vol_id]
+        projections = self._objects_[sin_id]
+        
+        regions = self._regions_(projector, bricks)
+        
+        if algorithm == 'FP3D_CUDA':
+            self._forward_(projector, volume, projections, regions)
+            
+        elif algorithm == 'BP3D_CUDA':
+            self._back_(projector, volume, projections, regions, 'bp')
             
         elif algorithm == 'FDK_CUDA':
-            asex.accumulate_FDK(projector_id, vol_id, sin_id)
+            self._back_(projector, volume, _fdk_prefilter_(projections, projector['vectors'], threads = self.threads), regions, 'fdk')
+            
+        elif algorithm == 'FDK_FILTERED':
+            self._back_(projector, volume, projections, regions, 'fdk')
             
         else:
             raise ValueError('Unknown ASTRA algorithm type.')
+            
+    def _regions_(self, projector, bricks = None):
+        """
+        Boxes [z0, z1, y0, y1, x0, x1] of the volume to project: slabs of slices that fit in self.slab voxels, 
+        or active bricks if a BrickMap of this volume is given.
+        """
+        nz, ny, nx = projector['vol_shape']
+        
+        if (bricks is not None) and (bricks.shape == (nz, ny, nx)):
+            return bricks.boxes()
+            
+        step = max(1, self.slab * 4 // (ny * nx * projector['taps'] ** 2))
+        
+        return [[z0, min(z0 + step, nz), 0, ny, 0, nx] for z0 in range(0, nz, step)]
+        
+    def _map_(self, function, jobs):
+        """
+        Run jobs in a thread pool (NumPy releases the GIL in the heavy parts).
+        """
+        if (self.threads > 1) & (len(jobs) > 1):
+            
+            from concurrent.futures import ThreadPoolExecutor
+            
+            with ThreadPoolExecutor(self.threads) as executor:
+                list(executor.map(function, jobs))
+                
+        else:
+            list(map(function, jobs))
+            
+    def _forward_(self, projector, volume, projections, regions):
+        """
+        Accumulate the forward projection of the volume. Threads work on different angles. Empty regions are skipped.
+        """
+        rows, n, cols = projections.shape
+        
+        def project(k):
+            
+            image = numpy.zeros((rows + 2) * (cols + 2))
+            
+            # Footprints of several small regions are accumulated at once:
+            indexes, values = [], []
+            count = 0
+            
+            for box in regions:
+                
+                z0, z1, y0, y1, x0, x1 = box
+                
+                data = volume[z0:z1, y0:y1, x0:x1]
+                if not data.any(): continue
+                
+                index, weights = _cpu_splat_(projector, k, box, 'fp')
+                
+                indexes.append(index.ravel())
+                values.append((weights * data[None]).ravel())
+                count += data.size
+                
+                if count >= self.slab:
+                    image += numpy.bincount(numpy.concatenate(indexes), numpy.concatenate(values), minlength = image.size)
+                    indexes, values = [], []
+                    count = 0
+                    
+            if count > 0:
+                image += numpy.bincount(numpy.concatenate(indexes), numpy.concatenate(values), minlength = image.size)
+                
+            projections[:, k, :] += image.reshape(rows + 2, cols + 2)[1:-1, 1:-1]    
+            
+        self._map_(project, list(range(n)))
+        
+    def _back_(self, projector, volume, projections, regions, mode):
+        """
+        Accumulate the backprojection into the volume. Threads work on different regions.
+        """
+        rows, n, cols = projections.shape
+        
+        # Zero-padded images make footprints outside of the detector trivial:
+        padded = numpy.zeros((n, (rows + 2) * (cols + 2)), dtype = 'float32')
+        padded.reshape(n, rows + 2, cols + 2)[:, 1:-1, 1:-1] = numpy.transpose(projections, [1, 0, 2])
+        
+        def project(box):
+            
+            z0, z1, y0, y1, x0, x1 = box
+            update = numpy.zeros((z1 - z0, y1 - y0, x1 - x0))
+            
+            for k in range(n):
+                
+                index, weights = _cpu_splat_(projector, k, box, mode)
+                update += (weights * numpy.take(padded[k], index)).sum(0)
+                
+            volume[z0:z1, y0:y1, x0:x1] += update
+            
+        self._map_(project, regions)
+            
+def _cpu_projector_(proj_geom, vol_geom):
+    """
+    Precompute everything CPUBackend needs to project a pair of geometries.
+    """
+    vectors = numpy.asarray(proj_geom['Vectors'], dtype = 'float64')
+    rows = proj_geom['DetectorRowCount']
+    cols = proj_geom['DetectorColCount']
+    
+    src, det, u, v = vectors[:, 0:3], vectors[:, 3:6], vectors[:, 6:9], vectors[:, 9:12]
+    
+    # Detector normal pointing away from the source:
+    normal = numpy.cross(u, v)
+    dist = ((det - src) * normal).sum(1)
+    normal *= numpy.sign(dist)[:, None]
+    dist = numpy.abs(dist)
+    
+    # Dual vectors of the detector axes:
+    e_u = numpy.cross(v, normal)
+    e_u /= (u * e_u).sum(1)[:, None]
+    e_v = numpy.cross(u, normal)
+    e_v /= (v * e_v).sum(1)[:, None]
+    
+    # Projective matrices: [col, row, depth] = M * [x, y, z, 1] (col and row are divided by depth):
+    matrix = numpy.zeros((vectors.shape[0], 3, 4))
+    matrix[:, 2, :3] = normal
+    matrix[:, 2, 3] = -(normal * src).sum(1)
+    
+    for ii, (e, centre) in enumerate([[e_u, cols / 2 - 0.5], [e_v, rows / 2 - 0.5]]):
+        
+        a = ((src - det) * e).sum(1)
+        matrix[:, ii, :3] = a[:, None] * normal + dist[:, None] * e
+        matrix[:, ii, 3] = -a * (normal * src).sum(1) - dist * (e * src).sum(1)
+        matrix[:, ii] += centre * matrix[:, 2]
+    
+    # Voxel centres:
+    shape = (vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount'])
+    window = [[vol_geom['option']['WindowMin' + ax], vol_geom['option']['WindowMax' + ax]] for ax in ['Z', 'Y', 'X']]
+    
+    axes = [w[0] + (numpy.arange(n) + 0.5) * (w[1] - w[0]) / n for w, n in zip(window, shape)]
+    voxel = numpy.array([(w[1] - w[0]) / n for w, n in zip(window, shape)])
+    
+    # Angular step and radius of the source orbit (FDK weights):
+    dbeta, radius = _orbit_(src)
+    
+    # Number of pixels per dimension covered by the widest voxel footprint:
+    corners = numpy.meshgrid(*[ax[[0, -1]] for ax in axes], indexing = 'ij')
+    widest = max(numpy.max(_cpu_footprint_(M, corners[2], corners[1], corners[0], voxel)[1]) for M in matrix)
+    taps = int(numpy.ceil(widest - 1e-6)) + 1
+    
+    return {'matrix':matrix, 'src':src, 'dist':dist, 'normal':numpy.sqrt((normal ** 2).sum(1)), 
+            'axes':axes, 'voxel':voxel, 'vol_shape':shape, 'det_shape':(rows, cols), 
+            'dbeta':dbeta, 'radius':radius, 'vectors':vectors, 'taps':max(taps, 2)}
+    
+def _cpu_footprint_(M, x, y, z, voxel):
+    """
+    Projected coordinates [col, row] of voxels at x, y, z (broadcastable arrays) for the matrix M, their depth 
+    and the width of their footprints (in pixels). Following the distance-driven model, the width is the projected size 
+    of the voxel along the axis that projects to the longest segment, so footprints of neighbouring voxels tile the detector.
+    """
+    # Voxels behind the source get infinite depth (zero coordinates, width and weight):
+    depth = M[2, 0] * x + M[2, 1] * y + M[2, 2] * z + M[2, 3]
+    depth = numpy.where(depth > 0, depth, numpy.inf)
+    
+    coords, widths = [], []
+    
+    for ii in range(2):
+        
+        coord = (M[ii, 0] * x + M[ii, 1] * y + M[ii, 2] * z + M[ii, 3]) / depth
+        
+        # Derivatives along x, y and z times the voxel size (voxel is [z, y, x]):
+        width = [numpy.abs(M[ii, jj] - coord * M[2, jj]) * voxel[2 - jj] / depth for jj in range(3)]
+        
+        coords.append(coord)
+        widths.append(numpy.maximum(numpy.maximum(width[0], width[1]), width[2]))
+        
+    return coords, widths, depth
+    
+def _orbit_(src):
+    """
+    Fit a circle to the source positions. Returns the angular step per projection and the radius of the orbit.
+    """
+    n = src.shape[0]
+    
+    if n < 3:
+        return numpy.ones(n) * 2 * numpy.pi / n, numpy.sqrt((src ** 2).sum(1)).mean()
+        
+    # Plane of the orbit:
+    centre = src.mean(0)
+    basis = numpy.linalg.svd(src - centre, full_matrices = False)[2]
+    xy = numpy.dot(src - centre, basis[:2].T)
+    
+    # Algebraic circle fit:
+    A = numpy.stack([xy[:, 0], xy[:, 1], numpy.ones(n)], axis = 1)
+    b = (xy ** 2).sum(1)
+    c = numpy.linalg.lstsq(A, b, rcond = None)[0]
+    
+    c0 = c[:2] / 2
+    radius = numpy.sqrt(c[2] + (c0 ** 2).sum())
+    
+    # Gaps between sorted angles, gaps much larger than typical are the ends of a short scan:
+    phi = numpy.arctan2(xy[:, 1] - c0[1], xy[:, 0] - c0[0])
+    order = numpy.argsort(phi)
+    gaps = numpy.diff(numpy.concatenate([phi[order], [phi[order[0]] + 2 * numpy.pi]]))
+    
+    typical = numpy.median(gaps)
+    gaps[gaps > 3 * typical] = typical
+    
+    dbeta = numpy.zeros(n)
+    dbeta[order] = (gaps + numpy.roll(gaps, 1)) / 2
+    
+    return dbeta, radius
+    
+def _cpu_splat_(projector, k, box, mode):
+    """
+    Footprints of voxels in the box [z0, z1, y0, y1, x0, x1] of the volume for the k-th projection.
+    Footprints are separable boxes at least one pixel wide (bilinear interpolation for voxels smaller than a pixel), 
+    wider footprints of large voxels avoid gaps between their projections.
+    Returns the flat indexes of taps x taps neighbouring pixels in a zero-padded image and their weights (both shaped [taps^2, z, y, x]).
+    """
+    z0, z1, y0, y1, x0, x1 = box
+    
+    z, y, x = projector['axes']
+    z = z[z0:z1, None, None]
+    y = y[None, y0:y1, None]
+    x = x[None, None, x0:x1]
+    
+    rows, cols = projector['det_shape']
+    taps = projector['taps']
+    voxel = projector['voxel']
+    
+    (col, row), (w_col, w_row), depth = _cpu_footprint_(projector['matrix'][k], x, y, z, voxel)
+    
+    # Indexes (in the image padded by one pixel) and weights of the pixels overlapped by the footprint:
+    indexes, weights = [], []
+    
+    for coord, width, size in [[row, w_row, rows], [col, w_col, cols]]:
+        
+        width = numpy.clip(width, 1, taps - 1)
+        coord = numpy.clip(coord, -taps - 1, size + taps)
+        
+        left = coord - width / 2
+        first = numpy.floor(left + 0.5).astype('int64')
+        
+        pixels = first[None] + numpy.arange(taps).reshape((taps,) + (1,) * coord.ndim)
+        overlap = numpy.minimum(left + width, pixels + 0.5) - numpy.maximum(left, pixels - 0.5)
+        
+        indexes.append(numpy.clip(pixels + 1, 0, size + 1))
+        weights.append(numpy.maximum(overlap, 0) / width)
+    
+    # Scaling of the footprint:
+    volume = numpy.prod(voxel)
+    dist = projector['dist'][k]
+    
+    if mode == 'fdk':
+        # Feldkamp weight (distance and angular step), voxel^4 scaling is the convention of FDK in this module:
+        scale = volume ** (4/3) * projector['dbeta'][k] / 2 * projector['radius'] * dist * projector['normal'][k] / depth ** 2
+        
+    else:
+        # Line integral through a voxel (in mm) averaged over the pixel:
+        sx, sy, sz = projector['src'][k]
+        length = numpy.sqrt((x - sx) ** 2 + (y - sy) ** 2 + (z - sz) ** 2)
+        scale = volume * dist ** 2 * length / depth ** 3
+        
+        if mode == 'bp':
+            scale *= volume ** (2/3)
+    
+    shape = (taps ** 2,) + col.shape
+    
+    index = (indexes[0][:, None] * (cols + 2) + indexes[1][None, :]).reshape(shape)
+    weights = (weights[0][:, None] * weights[1][None, :] * scale).reshape(shape)
+    
+    return index, weights
+    
+# Ram-Lak filters keyed by detector width and pixel size:
+_RAMP_KERNELS_ = {}
+
+def _ramp_kernel_(cols, du):
+    """
+    Ram-Lak filter in the frequency domain for detector rows of cols pixels of size du (zero-padded to a power of 2).
+    """
+    key = (cols, float(du))
+    
+    ramp = _RAMP_KERNELS_.get(key)
+    
+    if ramp is None:
+        
+        # Ram-Lak kernel in mm (spatial domain avoids the DC offset of a sampled ramp):
+        length = int(2 ** numpy.ceil(numpy.log2(2 * cols)))
+        
+        k = numpy.arange(length)
+        k[k > length // 2] -= length
+        
+        kernel = numpy.zeros(length)
+        kernel[0] = 1 / (4 * du ** 2)
+        kernel[k % 2 == 1] = -1 / (numpy.pi * k[k % 2 == 1] * du) ** 2
+        
+        ramp = numpy.real(numpy.fft.rfft(kernel)) * du
+        
+        _RAMP_KERNELS_[key] = ramp
+        
+    return ramp
+    
+def _fdk_cosine_(vectors, rows, cols, first = 0, last = None):
+    """
+    Cosine of the angle between the rays and the detector normal for detector rows [first, last) (shaped [rows, angles, cols]).
+    """
+    src, det, u, v = vectors[:, 0:3], vectors[:, 3:6], vectors[:, 6:9], vectors[:, 9:12]
+    
+    # Distance from the source to the detector plane:
+    normal = numpy.cross(u, v)
+    dist = numpy.abs(((det - src) * normal).sum(1)) / numpy.sqrt((normal ** 2).sum(1))
+    
+    c = numpy.arange(cols) - cols / 2 + 0.5
+    r = (numpy.arange(rows) - rows / 2 + 0.5)[first:last]
+    
+    pixels = (det - src)[None, :, None, :] + r[:, None, None, None] * v[None, :, None, :] + c[None, None, :, None] * u[None, :, None, :]
+    
+    return dist[None, :, None] / numpy.sqrt((pixels ** 2).sum(3))
+    
+def _fdk_prefilter_(projections, vectors, out = None, threads = 1, scale = 1):
+    """
+    Cosine weighting and ramp filtering of projections for FDK. Rows are independent and are filtered a few at a time.
+    """
+    import scipy.fft
+    
+    rows, n, cols = projections.shape
+    
+    du = numpy.sqrt((vectors[:, 6:9] ** 2).sum(1)).mean()
+    ramp = _ramp_kernel_(cols, du)
+    length = (ramp.size - 1) * 2
+    
+    if out is None:
+        out = numpy.zeros(projections.shape, dtype = 'float32')
+        
+    # Rows per chunk (about 4M pixels):
+    chunk = max(1, 2**22 // (n * cols))
+    
+    for r0 in range(0, rows, chunk):
+        
+        r1 = min(r0 + chunk, rows)
+        
+        block = projections[r0:r1] * _fdk_cosine_(vectors, rows, cols, r0, r1)
+        
+        if scale != 1:
+            block *= scale
+        
+        block = scipy.fft.rfft(block, length, axis = 2, workers = threads)
+        block *= ramp
+        
+        out[r0:r1] = scipy.fft.irfft(block, length, axis = 2, workers = threads)[:, :, :cols]
+        
+    return out
+
+def set_backend(backend = None):
+    """
+    Set the projector backend used by new projector sessions: 'astra', 'cpu' or a backend object.
+    Any object with the methods of AstraBackend can be used, for instance a stub for testing.
+    None restores the default: AstraBackend if CUDA is available, CPUBackend otherwise.
+    """
+    global _BACKEND_
+    
+    if backend == 'astra':
+        backend = AstraBackend()
+        
+    elif backend == 'cpu':
+        backend = CPUBackend()
+    
+    _BACKEND_ = backend
+    
+def get_backend():
+    """
+    Get the projector backend used by new projector sessions.
+    """
+    if _BACKEND_ is None:
+        
+        if astra.use_cuda():
+            return AstraBackend()
+            
+        else:
+            return CPUBackend()
+    
+    return _BACKEND_
+    
+def _geom_key_(geom):
+    """
+    Hashable key of an ASTRA geometry record.
+    """
+    key = []
+    for name in sorted(geom):
+        value = geom[name]
+        
+        if isinstance(value, dict):
+            value = _geom_key_(value)
+            
+        elif isinstance(value, numpy.ndarray):
+            value = (value.shape, value.tobytes())
+            
+        key.append((name, value))
+        
+    return tuple(key)
+    
+class BufferPool:
+    """
+    Preallocated arrays reused by all blocks and iterations of a reconstruction. Buffers are keyed by name, shape and dtype.
+    """
+    def __init__(self):
+        self._buffers_ = {}
+        
+    def get(self, name, shape, dtype = 'float32', fill = None):
+        """
+        Get a contiguous buffer. Its content is left from the previous use unless fill value is given.
+        """
+        key = (name, tuple(shape), numpy.dtype(dtype).str)
+        
+        buffer = self._buffers_.get(key)
+        
+        if buffer is None:
+            buffer = numpy.empty(shape, dtype = dtype)
+            self._buffers_[key] = buffer
+            
+        if fill is not None:
+            buffer.fill(fill)
+            
+        return buffer
+        
+    def nbytes(self):
+        """
+        Memory held by the pool.
+        """
+        return sum(buffer.nbytes for buffer in self._buffers_.values())
+        
+    def clear(self):
+        self._buffers_ = {}
+    
+class SensitivityCache:
+    """
+    Forward projected row sums and backprojected column sums (sensitivity images) of projection blocks.
+    Sums are computed over the whole volume (inactive bricks are not skipped), so they only depend on the geometry.
+    Every image is computed once per block geometry and kept in RAM while it fits in max_memory (bytes).
+    If path is given, images are also stored there as .npy files and reused by later reconstructions.
+    """
+    def __init__(self, path = None, max_memory = 2**32):
+        
+        self.path = path
+        self.max_memory = max_memory
+        
+        self._images_ = {}
+        self._memory_ = 0
+        
+        if path is not None:
+            os.makedirs(path, exist_ok = True)
+        
+    def _hash_(self, key):
+        
+        import hashlib
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+        
+    def get(self, key):
+        """
+        Find a cached image. Returns None if it doesn't exist.
+        """
+        name = self._hash_(key)
+        
+        image = self._images_.get(name)
+        
+        if (image is None) & (self.path is not None):
+            
+            file = os.path.join(self.path, name + '.npy')
+            
+            if os.path.exists(file):
+                image = numpy.load(file, mmap_mode = 'r')
+                
+        return image
+        
+    def put(self, key, image, persist = True):
+        """
+        Store an image. Images that depend on anything else than geometry should use persist = False.
+        """
+        name = self._hash_(key)
+        
+        if self.fits(image.nbytes):
+            self._images_[name] = image
+            self._memory_ += image.nbytes
+            
+        if (self.path is not None) & persist:
+            numpy.save(os.path.join(self.path, name + '.npy'), image)
+            
+        return image
+            
+    def fits(self, nbytes):
+        """
+        Check if an image of nbytes can still be kept in RAM.
+        """
+        return self._memory_ + nbytes <= self.max_memory
+        
+    def clear(self):
+        """
+        Release images kept in RAM.
+        """
+        self._images_ = {}
+        self._memory_ = 0
+        
+    def rows(self, proj_geom, vol_geom, session, inverse = False):
+        """
+        Forward projection of a volume of ones (row sums). With inverse, 1 / row sums (0 for rays that miss the volume).
+        """
+        key = ('rows', _geom_key_(proj_geom), _geom_key_(vol_geom), inverse)
+        image = self.get(key)
+        
+        if image is None:
+            
+            shape = (proj_geom['DetectorRowCount'], proj_geom['Vectors'].shape[0], proj_geom['DetectorColCount'])
+            ones = session.pool.get('ones_volume', _vol_shape_(vol_geom), fill = 1)
+            
+            image = numpy.zeros(shape, dtype = 'float32')
+            session.accumulate('FP3D_CUDA', image, ones, proj_geom, vol_geom, bricks = False)
+            
+            if inverse: 
+                image = _safe_inverse_(image)
+                
+            image = self.put(key, image)
+            
+        return image
+        
+    def columns(self, proj_geom, vol_geom, session, floor = None, inverse = False):
+        """
+        Backprojection of projections of ones (column sums). Values below floor * maximum are set to that value
+        (floor is relative: the scale of column sums depends on the backend and the voxel size).
+        With inverse, 1 / column sums (0 for voxels that are not seen).
+        """
+        key = ('columns', _geom_key_(proj_geom), _geom_key_(vol_geom), floor, inverse)
+        image = self.get(key)
+        
+        if image is None:
+            
+            shape = (proj_geom['DetectorRowCount'], proj_geom['Vectors'].shape[0], proj_geom['DetectorColCount'])
+            ones = session.pool.get('ones', shape, fill = 1)
+            
+            image = numpy.zeros(_vol_shape_(vol_geom), dtype = 'float32')
+            session.accumulate('BP3D_CUDA', ones, image, proj_geom, vol_geom, persistent = False, bricks = False)
+            
+            if floor is not None:
+                numpy.maximum(image, floor * image.max(), out = image)
+                
+            if inverse: 
+                image = _safe_inverse_(image)
+                
+            image = self.put(key, image)
+            
+        return image
+        
+def _vol_shape_(vol_geom):
+    """
+    Shape of a volume described by ASTRA volume geometry.
+    """
+    return (vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount'])
+    
+def _safe_inverse_(image, eps = 1e-6):
+    """
+    1 / image where image is larger than eps * max, 0 elsewhere.
+    """
+    inverse = numpy.zeros_like(image)
+    valid = image > eps * image.max()
+    inverse[valid] = 1 / image[valid]
+    
+    return inverse
+    
+class BrickMap:
+    """
+    Occupancy map of a volume split in bricks of size^3 voxels. Projectors of CPUBackend skip inactive bricks:
+    they are not forward projected and are not updated by backprojection. Every recheck updates all bricks 
+    (inside of the support) are activated for one update: bricks that the backprojected residual makes non-zero stay active.
+    
+    Args:
+        shape    : shape of the volume
+        size     : size of a brick in voxels
+        patience : number of updates a brick has to stay at zero to become inactive
+        recheck  : number of updates between reactivations (None - inactive bricks stay inactive)
+    """
+    def __init__(self, shape, size = 32, patience = 2, recheck = 10):
+        
+        self.shape = tuple(shape)
+        self.size = size
+        self.patience = patience
+        self.recheck = recheck
+        
+        grid = [int(numpy.ceil(x / size)) for x in shape]
+        
+        self.active = numpy.ones(grid, dtype = 'bool')
+        self._zero_ = numpy.zeros(grid, dtype = 'int32')
+        
+        # Bricks that can be active (support) and the number of updates:
+        self._allowed_ = numpy.ones(grid, dtype = 'bool')
+        self._count_ = 0
+        
+    def occupied(self, array):
+        """
+        Bricks that contain non-zero values of the array. Computed one layer of bricks at a time.
+        """
+        occupied = numpy.zeros(self.active.shape, dtype = 'bool')
+        
+        starts_y = numpy.arange(0, self.shape[1], self.size)
+        starts_x = numpy.arange(0, self.shape[2], self.size)
+        
+        for ii in range(occupied.shape[0]):
+            
+            layer = (array[ii * self.size:(ii + 1) * self.size] != 0).any(0)
+            layer = numpy.logical_or.reduceat(layer, starts_y, axis = 0)
+            
+            occupied[ii] = numpy.logical_or.reduceat(layer, starts_x, axis = 1)
+            
+        return occupied
+    
+    def restrict(self, mask):
+        """
+        Deactivate bricks outside of a support mask (see find_support).
+        """
+        self._allowed_ &= self.occupied(mask)
+        self.active &= self._allowed_
+        
+    def update(self, volume):
+        """
+        Count how long the bricks of the volume stay at zero, deactivate those that stayed there for patience updates.
+        """
+        zero = ~self.occupied(volume)
+        
+        self._zero_[zero] += 1
+        self._zero_[~zero] = 0
+        
+        self.active &= self._zero_ < self.patience
+        
+        # Reactivate bricks for one update (if they stay at zero, they are inactive again after it):
+        self._count_ += 1
+        
+        if self.recheck and (self._count_ % self.recheck == 0):
+            
+            self._zero_[~self.active] = self.patience - 1
+            self.active = self._allowed_.copy()
+        
+    def boxes(self):
+        """
+        Active bricks as boxes [z0, z1, y0, y1, x0, x1] of the volume.
+        """
+        s = self.size
+        nz, ny, nx = self.shape
+        
+        return [[z * s, min((z + 1) * s, nz), y * s, min((y + 1) * s, ny), x * s, min((x + 1) * s, nx)] 
+                for z, y, x in numpy.argwhere(self.active)]
+    
+    def clear(self, volume):
+        """
+        Set inactive bricks of the volume to zero (backends that don't skip bricks may have updated them).
+        """
+        s = self.size
+        
+        for z, y, x in numpy.argwhere(~self.active):
+            volume[z * s:(z + 1) * s, y * s:(y + 1) * s, x * s:(x + 1) * s] = 0
+            
+    def fraction(self):
+        """
+        Fraction of active bricks.
+        """
+        return self.active.mean()
+        
+def _session_(session = None):
+    """
+    Context manager of a projector session: the given session (it is left open) or a temporary one (closed at exit).
+    """
+    if session is None: 
+        return ProjectorSession()
+        
+    return contextlib.nullcontext(session)
+    
+class ProjectorSession:
+    """
+    Keeps projectors (one per block geometry) and volume links alive for the duration of a reconstruction.
+    Only the projection buffers are linked per call. Temporary arrays of the solvers are taken from self.pool.
+    Use as a context manager or call close() at the end.
+    
+    Args:
+        backend    : projector backend (see set_backend)
+        cache_size : maximum number of projectors kept alive (least recently used are deleted first)
+        volume_cache_size : maximum number of volume links kept alive
+        sensitivity_path  : directory where sensitivity images are stored (see SensitivityCache)
+    """
+    def __init__(self, backend = None, cache_size = 128, volume_cache_size = 8, sensitivity_path = None):
+        
+        if backend is None: backend = get_backend()
+        
+        self.backend = backend
+        self.cache_size = cache_size
+        self.volume_cache_size = volume_cache_size
+        
+        # Projectors and links of persistent volumes:
+        self._projectors_ = {}
+        self._volumes_ = {}
+        
+        # Count of created objects (for diagnostics):
+        self.created = {'projectors': 0, 'links': 0}
+        
+        # Temporary buffers of the solvers:
+        self.pool = BufferPool()
+        
+        # Row and column sums of projection blocks:
+        self.sensitivity = SensitivityCache(sensitivity_path)
+        
+        # Occupancy map of the reconstructed volume (BrickMap). Passed to backends that can skip empty bricks:
+        self.bricks = None
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+    def projector(self, proj_geom, vol_geom):
+        """
+        Get a projector for the pair of geometries. Create it if it is not cached.
+        """
+        key = (_geom_key_(proj_geom), _geom_key_(vol_geom))
+        
+        projector_id = self._projectors_.pop(key, None)
+        
+        if projector_id is None:
+            
+            # Delete the least recently used projector:
+            if len(self._projectors_) >= self.cache_size:
+                self.backend.delete_projector(self._projectors_.pop(next(iter(self._projectors_))))
+                
+            projector_id = self.backend.create_projector(proj_geom, vol_geom)
+            self.created['projectors'] += 1
+            
+        self._projectors_[key] = projector_id
+        
+        return projector_id
+        
+    def volume_link(self, volume, vol_geom):
+        """
+        Get a link to a persistent volume array. The array is referenced by the session until it is closed.
+        """
+        key = (id(volume), _geom_key_(vol_geom))
+        
+        record = self._volumes_.pop(key, None)
+        
+        if record is None:
+            
+            # Delete the least recently used link:
+            if len(self._volumes_) >= self.volume_cache_size:
+                self.backend.delete(self._volumes_.pop(next(iter(self._volumes_)))[0])
+                
+            vol_id = self.backend.link('-vol', vol_geom, volume)
+            self.created['links'] += 1
+            
+            # Keep the array so its memory can't be reused by another array with the same id:
+            record = [vol_id, volume]
+            
+        self._volumes_[key] = record
+            
+        return record[0]
+        
+    def accumulate(self, algorithm, projections, volume, proj_geom, vol_geom, persistent = True, bricks = True):
+        """
+        Forward- or backproject a single block using cached objects.
+        
+        Args:
+            algorithm   : 'FP3D_CUDA', 'BP3D_CUDA' or 'FDK_CUDA'
+            persistent  : if False, volume is a temporary array and its link is deleted after use 
+            bricks      : if False, inactive bricks of self.bricks are projected as well
+        """
+        projector_id = self.projector(proj_geom, vol_geom)
+        
+        if persistent:
+            vol_id = self.volume_link(volume, vol_geom)
+            
+        else:
+            vol_id = self.backend.link('-vol', vol_geom, volume)
+            self.created['links'] += 1
+            
+        sin_id = self.backend.link('-sino', proj_geom, projections)
+        self.created['links'] += 1
+        
+        try:
+            if bricks and (self.bricks is not None) and (self.bricks.shape == tuple(volume.shape)):
+                self.backend.accumulate(algorithm, projector_id, vol_id, sin_id, bricks = self.bricks)
+                
+            else:
+                self.backend.accumulate(algorithm, projector_id, vol_id, sin_id)
+            
+        finally:
+            self.backend.delete(sin_id)
+            
+            if not persistent:
+                self.backend.delete(vol_id)
+        
+    def close(self):
+        """
+        Delete all cached projectors, links and buffers.
+        """
+        for projector_id in self._projectors_.values():
+            self.backend.delete_projector(projector_id)
+            
+        for vol_id, volume in self._volumes_.values():
+            self.backend.delete(vol_id)
+            
+        self._projectors_ = {}
+        self._volumes_ = {}
+        
+        self.pool.clear()
+        self.sensitivity.clear()
+
+def _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'BP3D_CUDA', operation = '+', session = None):
+    """
+    Use this internal function to compute backprojection of a single block of data.
+    If session is None, a temporary projector session is used and closed afterwards.
+    """           
+    own_session = session is None
+    if own_session: session = ProjectorSession()
+    
+    try:
+        
+        if (operation == '+') | (operation == '-'):
+            volume_ = volume
+            
+        elif (operation == '*') | (operation == '/'):
+            volume_ = session.pool.get('backproject', volume.shape, fill = 0)
+            
+        else: raise ValueError('Unknown operation type!')
+        
+        if (operation == '-'):
+            projections *= -1
+                    
+        session.accumulate(algorithm, projections, volume_, proj_geom, vol_geom)
         
         if (operation == '-'):
             projections *= -1            
@@ -97,23 +1045,8 @@ def _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'B
             
              volume *= volume_
             
-             #flexUtil.display_slice(volume, dim = 0, title = 'worm')
-            
-             # This is really slow but needed in case of overlap for EM: 
-             volume_ *= 0
-             astra.data3d.delete(sin_id)
-             sin_id = astra.data3d.link('-sino', proj_geom, projections * 0 + 1)
-             
-             asex.accumulate_BP(projector_id, vol_id, sin_id)
-             
-             #flexUtil.display_slice(volume_, dim = 0, title = 'norm')
-             
-             volume_[volume_ < 0.01] = 0.01
-             
-             volume /= volume_
-             
-             #flexUtil.display_slice(volume, dim = 0, title = 'rorm')
-             
+             # Normalization is needed in case of overlap for EM. It is computed once per block geometry: 
+             volume /= session.sensitivity.columns(proj_geom, vol_geom, session, floor = 1e-3)
              
         elif (operation == '/'):
              volume_[volume_ < 1e-3] = numpy.inf
@@ -123,36 +1056,30 @@ def _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'B
         print("ASTRA error:", sys.exc_info())
         
     finally:
-        astra.algorithm.delete(projector_id)
-        astra.data3d.delete(sin_id)
-        astra.data3d.delete(vol_id)                 
+        if own_session: session.close()
             
-def _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation = '+'):
+def _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation = '+', session = None):
     """
     Use this internal function to compute backprojection of a single block of data.
+    If session is None, a temporary projector session is used and closed afterwards.
     """           
-    # Unfortunately need to hide the experimental ASTRA
-    import astra.experimental as asex 
+    own_session = session is None
+    if own_session: session = ProjectorSession()
     
     try:
         
-        if (operation == '+'):
+        if (operation == '+') | (operation == '-'):
             projections_ = projections
             
-        elif (operation == '-'):
-            projections_ = -projections
-            
         elif (operation == '*') | (operation == '/'):
-            projections_ = numpy.zeros_like(projections)
+            projections_ = session.pool.get('forwardproject', projections.shape, fill = 0)
             
-        else: ValueError('Unknown operation type!')    
+        else: raise ValueError('Unknown operation type!')    
                 
-        sin_id = astra.data3d.link('-sino', proj_geom, projections_)        
-        vol_id = astra.data3d.link('-vol', vol_geom, volume)    
-        
-        projector_id = astra.create_projector('cuda3d', proj_geom, vol_geom)
-        
-        asex.accumulate_FP(projector_id, vol_id, sin_id)
+        if (operation == '-'):
+            projections *= -1
+            
+        session.accumulate('FP3D_CUDA', projections_, volume, proj_geom, vol_geom)
         
         if (operation == '*'):
              projections *= projections_
@@ -162,20 +1089,21 @@ def _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation =
              projections /= projections_
              
         elif (operation == '-'):
-            projections[:] = -projections_[:]
+            projections *= -1
              
     except:
         print("ASTRA error:", sys.exc_info())
         
     finally:
-        astra.algorithm.delete(projector_id)
-        astra.data3d.delete(sin_id)
-        astra.data3d.delete(vol_id)           
+        if own_session: session.close()
             
-def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operation = '+'):
+def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operation = '+', session = None):
     """
     Backproject useing standard ASTRA functionality
     """
+    if algorithm == 'FDK_FILTERED':
+        _check_filtered_(geometry, session.backend if session else None)
+        
     # If the data is not memmap:        
     if not isinstance(projections, numpy.memmap):    
         
@@ -185,7 +1113,7 @@ def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operatio
         vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
         proj_geom = flexData.astra_proj_geom(geometry, projections.shape)    
         
-        _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm, operation)
+        _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm, operation, session)
         
     else:
         # Decide on the size of the block:
@@ -195,60 +1123,115 @@ def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operatio
         # Initialize ASTRA geometries:
         vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
         
-        # Loop over blocks:
-        for ii in range(n // l):
+        # Share projector objects between the blocks:
+        with _session_(session) as session:
+        
+            # Loop over blocks:
+            for ii in range(n // l):
             
-            i0 = (ii * l)
-            i1 = min((ii * l + l), n+1)
+                i0 = (ii * l)
+                i1 = min((ii * l + l), n+1)
             
-            # Extract a block:
-            proj_geom = flexData.astra_proj_geom(geometry, projections.shape, numpy.arange(i0, i1))    
+                # Extract a block:
+                proj_geom = flexData.astra_proj_geom(geometry, projections.shape, numpy.arange(i0, i1))    
             
-            block = numpy.ascontiguousarray(projections[:, i0:i1,:])
+                block = _get_block_(projections, numpy.arange(i0, i1))
             
-            # Backproject:    
-            _backproject_block_(block, volume, proj_geom, vol_geom, algorithm, operation)  
+                # Backproject:    
+                _backproject_block_(block, volume, proj_geom, vol_geom, algorithm, operation, session)  
             
-def forwardproject(projections, volume, geometry, operation = '+'):
+            
+def forwardproject(projections, volume, geometry, operation = '+', session = None, slab = None, window = True, process = None):
     """
     Forwardproject
+    If slab is given (or volume is numpy.memmap) the volume is read in slabs of that many slices and their projections are accumulated.
+    
+    Args:
+        window  : project each slab only onto the detector rows that it can reach
+        process : function applied to every volume slab before projection (e.g. thresholding), slab mode only
     """
-    # If the data is not memmap:        
-    if not isinstance(volume, numpy.memmap):   
+    # Out-of-core volume:
+    if isinstance(volume, numpy.memmap) & (slab is None):
+        slab = 32
+        
+    if slab is None:   
         
         # Initialize ASTRA geometries:
         vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
         proj_geom = flexData.astra_proj_geom(geometry, projections.shape)
         
-        _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation)
+        _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation, session)
         
     else:
         
-        # Decide on the size of the block:
-        n = volume.shape[0]    
-        l = n // 10
-        
-        # Initialize ASTRA geometries:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape)    
-        
-        # Loop over blocks:
-        for ii in range(n // l):
+        if (operation == '+'):
+            _forwardproject_slabs_(projections, volume, geometry, slab, window, process, session)
+            
+        elif (operation == '-'):
+            projections *= -1
+            _forwardproject_slabs_(projections, volume, geometry, slab, window, process, session)
+            projections *= -1
+            
+        elif (operation == '*') | (operation == '/'):
             
-            i0 = (ii * l)
-            i1 = min((ii * l + l), n+1)
+            # Full projection has to be accumulated before it can be applied:
+            projections_ = numpy.zeros(projections.shape, dtype = 'float32')
+            _forwardproject_slabs_(projections_, volume, geometry, slab, window, process, session)
             
-            # Extract a block:
-            vol_geom = flexData.astra_vol_geom(geometry, volume.shape, i0, i1)
+            if (operation == '*'):
+                projections *= projections_
+                
+            else:
+                projections_[projections_ < 1e-10] = numpy.inf        
+                projections /= projections_
             
-            block = numpy.ascontiguousarray(projections[i0:i1, :, :])
-
-            # Forwardproject:
-            _forwardproject_block_(block, volume, proj_geom, vol_geom, operation)  
+        else: raise ValueError('Unknown operation type!')
                      
-def init_volume(projections, geometry = None):
+def _forwardproject_slabs_(projections, volume, geometry, slab, window = True, process = None, session = None):
+    """
+    Add the forward projection of the volume to projections, reading one slab of slices at a time.
+    Slabs share the projectors of the session (a temporary session if None).
+    """
+    proj_geom = flexData.astra_proj_geom(geometry, projections.shape)
+    
+    length = volume.shape[0]
+    
+    with _session_(session) as session:
+        
+        for z0 in range(0, length, slab):
+            
+            z1 = min(z0 + slab, length)
+            
+            block = numpy.ascontiguousarray(volume[z0:z1], dtype = 'float32')
+            
+            if process is not None:
+                block = numpy.ascontiguousarray(process(block), dtype = 'float32')
+                
+            if not block.any(): continue
+            
+            # Geometry of the slab and the detector rows that see it:
+            vol_geom = flexData.astra_vol_geom(geometry, volume.shape, z0, z1 - 1)
+            
+            if window:
+                r0, r1 = _detector_window_(proj_geom, vol_geom)
+            else:
+                r0, r1 = 0, projections.shape[0]
+                
+            if r1 <= r0: continue
+                
+            rows = numpy.zeros((r1 - r0,) + projections.shape[1:], dtype = 'float32')
+            
+            _forwardproject_block_(rows, block, _crop_rows_(proj_geom, r0, r1), vol_geom, '+', session)
+            
+            projections[r0:r1] += rows
+        
+def init_volume(projections, geometry = None, roi = None):
     """
     Initialize a standard volume array.
+    If roi is given ([[z_min, z_max], [y_min, y_max], [x_min, x_max]] in mm), the volume of the region of interest is returned.
     """          
+    if roi is not None:
+        return numpy.zeros(roi_geometry(projections, geometry, roi)[2], dtype = 'float32')
     
     if geometry:
         sample = geometry['sample']
@@ -263,6 +1246,228 @@ def init_volume(projections, geometry = None):
     shape = projections[::sample[0], ::sample[1], ::sample[2]].shape
     return numpy.zeros([shape[0], shape[2]+offset, shape[2]+offset], dtype = 'float32')
     
+def roi_geometry(projections, geometry, roi, columns = True):
+    """
+    Geometry of a region of interest and the part of the detector that sees it.
+    FDK of a region of interest is the same as a crop of the full FDK. Iterative methods would attribute
+    the material outside of the box that is crossed by the same rays to the box - SIRT and EM subtract 
+    its part of the data, estimated with a coarse FDK of the whole volume, from the detector window.
+    
+    Args:
+        projections : projection data
+        geometry    : geometry of the full reconstruction
+        roi         : [[z_min, z_max], [y_min, y_max], [x_min, x_max]] in mm relative to the centre of the full volume
+        columns     : crop detector columns as well as rows (FDK needs complete rows for filtering)
+        
+    Returns:
+        projections (view of the detector window), geometry, shape of the ROI volume
+    """
+    roi = numpy.array(roi, dtype = 'float64')
+    samp = geometry['sample']
+    
+    # Size of the volume:
+    voxel = numpy.array(geometry['anisotropy']) * geometry['img_pixel']
+    shape = [max(int(numpy.ceil((b[1] - b[0]) / vx)), 1) for b, vx in zip(roi, voxel)]
+    
+    # Volume centre. vol_tra is [z, x, y]:
+    centre = roi.mean(1)
+    
+    geometry = geometry.copy()
+    vol_tra = geometry['vol_tra']
+    geometry['vol_tra'] = [vol_tra[0] + centre[0], vol_tra[1] + centre[2], vol_tra[2] + centre[1]]
+    
+    # Detector window that sees the ROI:
+    prj_shape = projections[::samp[0], ::samp[1], ::samp[2]].shape
+    
+    proj_geom = flexData.astra_proj_geom(geometry, prj_shape)
+    vol_geom = flexData.astra_vol_geom(geometry, shape)
+    
+    r0, r1 = _detector_window_(proj_geom, vol_geom, dim = 0)
+    
+    if columns:
+        c0, c1 = _detector_window_(proj_geom, vol_geom, dim = 2)
+    else:
+        c0, c1 = 0, prj_shape[2]
+        
+    # Move the detector centre to the centre of the window. Shifts are along the rotated detector axes, 
+    # det_hrz and det_vrt are applied before det_rot:
+    shift_r = (r0 + r1 - 1) / 2 - (prj_shape[0] - 1) / 2
+    shift_c = (c0 + c1 - 1) / 2 - (prj_shape[2] - 1) / 2
+    
+    vectors = proj_geom['Vectors'][0]
+    vectors_ = flexData.astra_proj_geom(dict(geometry, det_rot = 0), prj_shape, index = [0])['Vectors'][0]
+    
+    u, v = vectors_[6:9], vectors_[9:12]
+    
+    shift = shift_c * vectors[6:9] + shift_r * vectors[9:12]
+    shift = numpy.linalg.lstsq(numpy.stack([u, v], axis = 1), shift, rcond = None)[0]
+    
+    geometry['det_hrz'] = geometry['det_hrz'] + shift[0] * numpy.sqrt((u ** 2).sum())
+    geometry['det_vrt'] = geometry['det_vrt'] + shift[1] * numpy.sqrt((v ** 2).sum())
+    
+    projections = projections[r0 * samp[0]:r1 * samp[0], :, c0 * samp[2]:c1 * samp[2]]
+    
+    return projections, geometry, shape
+    
+def _apply_roi_(projections, volume, geometry, roi, columns = True, exterior = None):
+    """
+    Projections and geometry of the region of interest. Volume should have the shape of the ROI.
+    If exterior is given, the forward projection of the material outside of the ROI is subtracted from the projections 
+    (iterative methods need it, see _roi_exterior_). Projections are then a new array with sample = [1, 1, 1].
+    """
+    window, geometry_w, shape = roi_geometry(projections, geometry, roi, columns)
+    
+    if tuple(volume.shape) != tuple(shape):
+        raise ValueError('Volume shape doesn`t match the region of interest: %s v.s. %s. Use init_volume(projections, geometry, roi).' % (volume.shape, shape))
+    
+    if not exterior:
+        return window, geometry_w
+        
+    samp = geometry['sample']
+    
+    data = _roi_exterior_(projections, geometry, roi, window, geometry_w, exterior)
+    numpy.subtract(window[::samp[0], ::samp[1], ::samp[2]], data, out = data)
+        
+    return data, _sampled_geometry_(geometry_w)
+    
+def _roi_exterior_(projections, geometry, roi, window, geometry_w, sample = 2):
+    """
+    Part of the detector window data that comes from the material outside of the region of interest.
+    The material is estimated by FDK of the whole volume with voxels sample times larger. Coarse voxels are not accurate enough
+    to subtract their projection directly (the ROI would receive all of their error), instead the data is split 
+    between the exterior and the ROI in proportion to the forward projections of both parts of the coarse volume.
+    """
+    print('Estimating the material outside of the ROI...')
+    
+    geometry_c = geometry.copy()
+    geometry_c['anisotropy'] = [x * sample for x in geometry['anisotropy']]
+    
+    shape = [int(numpy.ceil(x / sample)) for x in init_volume(projections, geometry).shape]
+    exterior = numpy.zeros(shape, dtype = 'float32')
+    
+    FDK(projections, exterior, geometry_c)
+    
+    # FDK scales with voxel volume^(4/3). Negative values would make the split unstable:
+    exterior /= sample ** 4
+    numpy.maximum(exterior, 0, out = exterior)
+    
+    # Move the voxels of the ROI to a separate volume:
+    voxel = numpy.array(geometry_c['anisotropy']) * geometry['img_pixel']
+    index = tuple(slice(max(int(numpy.round(b[0] / vx + n / 2)), 0), max(int(numpy.round(b[1] / vx + n / 2)), 0)) for b, vx, n in zip(roi, voxel, shape))
+    
+    interior = numpy.zeros_like(exterior)
+    interior[index] = exterior[index]
+    exterior[index] = 0
+    
+    # Project both onto the window. The coarse volume stays where the full volume is:
+    geometry_p = geometry_w.copy()
+    geometry_p['anisotropy'] = geometry_c['anisotropy']
+    geometry_p['vol_tra'] = geometry['vol_tra']
+    
+    samp = geometry['sample']
+    window = window[::samp[0], ::samp[1], ::samp[2]]
+    
+    share = numpy.zeros(window.shape, dtype = 'float32')
+    total = numpy.zeros(window.shape, dtype = 'float32')
+    
+    with ProjectorSession() as session:
+        
+        forwardproject(share, exterior, geometry_p, session = session)
+        forwardproject(total, interior, geometry_p, session = session)
+        
+    total += share
+    
+    # Share of the exterior in the data (all data goes to the ROI where the coarse volume projects to nothing):
+    share *= _safe_inverse_(total)
+    
+    return share * window
+    
+def find_support(projections, geometry, threshold = None, sample = 4, margin = 2, mask = True):
+    """
+    Estimate the support of the object by intersection of its silhouettes (space carving) in subsampled projections.
+    Voxels that project onto air (projections < threshold) in any of the projections are outside of the object.
+    
+    Args:
+        projections : projection data
+        geometry    : geometry of the full reconstruction
+        threshold   : air / object threshold of projections. Default is half of the Otsu threshold.
+        sample      : subsampling of detector, angles and volume
+        margin      : dilation of the support (in subsampled voxels)
+        mask        : compute support mask of the ROI volume
+        
+    Returns:
+        box (can be used as roi in init_volume, FDK, SIRT and EM), support mask of the ROI volume (or None)
+    """
+    from scipy import ndimage
+    
+    samp = geometry['sample']
+    
+    # Subsampled problem:
+    geometry_ = _level_geometry_(geometry, projections.shape[1], sample)
+    
+    prj = numpy.ascontiguousarray(projections[::samp[0] * sample, ::samp[1] * sample, ::samp[2] * sample], dtype = 'float32')
+    
+    shape = init_volume(projections, geometry).shape
+    shape = [int(numpy.ceil(x / sample)) for x in shape]
+    
+    if threshold is None:
+        import skimage.filters
+        threshold = skimage.filters.threshold_otsu(prj) / 2
+        
+    print('Carving the support at threshold %0.3f...' % threshold)
+    
+    # Backproject air and the complete detector:
+    proj_geom = flexData.astra_proj_geom(geometry_, prj.shape)
+    vol_geom = flexData.astra_vol_geom(geometry_, shape)
+    
+    air = numpy.zeros(shape, dtype = 'float32')
+    seen = numpy.zeros(shape, dtype = 'float32')
+    
+    with ProjectorSession() as session:
+        
+        _backproject_block_(numpy.float32(prj < threshold), air, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
+        
+        prj[:] = 1
+        _backproject_block_(prj, seen, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
+    
+    # Less than a half of a projection sees air there:
+    support = (air < 0.5 * seen / prj.shape[1]) & (seen > 0)
+    
+    if margin > 0:
+        support = ndimage.binary_dilation(support, iterations = margin)
+        
+    if not support.any():
+        raise ValueError('Support is empty. Check the threshold.')
+        
+    # Bounding box in mm relative to the volume centre:
+    voxel = numpy.array(geometry_['anisotropy']) * geometry['img_pixel']
+    box = []
+    
+    for dim in range(3):
+        
+        index = numpy.where(support.any(tuple(x for x in range(3) if x != dim)))[0]
+        centre = (shape[dim] - 1) / 2
+        
+        box.append([(index[0] - centre - 0.5) * voxel[dim], (index[-1] - centre + 0.5) * voxel[dim]])
+        
+    if not mask:
+        return box, None
+    
+    # Nearest voxel of the support for each voxel of the ROI volume:
+    roi_shape = roi_geometry(projections, geometry, box)[2]
+    roi_voxel = numpy.array(geometry['anisotropy']) * geometry['img_pixel']
+    
+    index = []
+    
+    for dim in range(3):
+        
+        x = box[dim][0] + (numpy.arange(roi_shape[dim]) + 0.5) * roi_voxel[dim]
+        x = numpy.round(x / voxel[dim] + (shape[dim] - 1) / 2)
+        
+        index.append(numpy.clip(x, 0, shape[dim] - 1).astype('int'))
+        
+    return box, support[numpy.ix_(*index)]
+    
 def sample_FDK(projections, geometry, sample = [1,1,1]):
     """
     Quick reconstruction of a subsampled version of FDK
@@ -293,21 +1498,144 @@ def sample_FDK(projections, geometry, sample = [1,1,1]):
     
     return volume 
     
-def FDK(projections, volume, geometry):
+def fdk_filter(projections, geometry, out = None, threads = None):
+    """
+    Weighting and ramp filtering stage of FDK, computed once on the CPU. Filtered projections can be backprojected 
+    many times with FDK(..., filtered = True): repeated ROI reconstructions or geometry sweeps. Weights depend on the
+    positions of the source and the detector, so a shift of the rotation axis or of the volume doesn't change them.
+    Backends without the prefilter attribute only get scaled data and filter it at every backprojection.
+    The name of the current backend is stored in geometry['fdk_filter'], the data can't be backprojected by another backend.
+    
+    Args:
+        projections : projection data
+        geometry    : geometry
+        out         : array for the result of shape projections[::sample].shape, e.g. numpy.memmap to keep it on disk
+        threads     : number of threads of FFT (number of cores by default)
+        
+    Returns:
+        filtered projections, geometry of the filtered projections (subsampling is already applied)
+    """
+    samp = geometry['sample']
+    projections = projections[::samp[0], ::samp[1], ::samp[2]]
+    
+    scale = 1 / (numpy.prod(samp) * geometry['img_pixel'])**4
+    
+    # Backends without prefilter filter the data themselves, only the scale is applied:
+    if not getattr(get_backend(), 'prefilter', False):
+        
+        filtered = numpy.multiply(projections, numpy.float32(scale), out = out, dtype = 'float32')
+        
+    else:
+        print('FDK filtering...')
+        
+        proj_geom = flexData.astra_proj_geom(geometry, projections.shape)
+        
+        filtered = _fdk_prefilter_(projections, proj_geom['Vectors'], out, threads or os.cpu_count(), scale)
+    
+    geometry = _sampled_geometry_(geometry)
+    geometry['fdk_filter'] = get_backend().name
+    
+    return filtered, geometry
+    
+def _check_filtered_(geometry, backend = None):
+    """
+    Make sure that projections with this geometry were filtered by fdk_filter for the backend that backprojects them.
+    """
+    backend = backend or get_backend()
+    
+    if geometry.get('fdk_filter') != backend.name:
+        raise ValueError('Projections are filtered for the %s backend, but the %s backend is used. Apply fdk_filter with the current backend.' % (geometry.get('fdk_filter'), backend.name))
+    
+def _sampled_geometry_(geometry):
+    """
+    Geometry of the subsampled data projections[::sample] with sample = [1, 1, 1].
+    """
+    samp = geometry['sample']
+    geometry = geometry.copy()
+    
+    geometry['det_pixel'] = geometry['det_pixel'] * numpy.array(samp, dtype = 'float64')
+    geometry['sample'] = [1, 1, 1]
+    
+    if geometry.get('_thetas_') is not None:
+        geometry['_thetas_'] = numpy.asarray(geometry['_thetas_'])[::samp[1]]
+        
+    return geometry
+    
+def FDK(projections, volume, geometry, slab = None, roi = None, filtered = False):
     """
     FDK.
+    If slab is given (or volume is numpy.memmap) the volume is reconstructed in slabs of that many slices.
+    Each slab reads only the detector rows it needs and is written to volume as soon as it is ready.
+    If roi is given ([[z_min, z_max], [y_min, y_max], [x_min, x_max]] in mm), only that box is reconstructed 
+    from the detector rows that see it. Volume should be created with init_volume(projections, geometry, roi).
+    If filtered, projections and geometry are the output of fdk_filter with the same backend - only the backprojection is computed.
     """
     print('FDK reconstruction...')
     
+    if filtered:
+        _check_filtered_(geometry)
+    
+    # Region of interest (unfiltered data needs complete detector rows):
+    if roi is not None:
+        columns = filtered and getattr(get_backend(), 'prefilter', False)
+        projections, geometry = _apply_roi_(projections, volume, geometry, roi, columns = columns)
+        
     # Sampling:
     samp = geometry['sample']
     
+    if filtered:
+        algorithm = 'FDK_FILTERED'
+        scale = 1
+        
+    else:
+        algorithm = 'FDK_CUDA'
+        scale = 1 / (numpy.prod(samp) * geometry['img_pixel'])**4
+    
+    # Out-of-core volume:
+    if isinstance(volume, numpy.memmap) & (slab is None):
+        slab = 32
+    
     # Make sure array is contiguous (if not memmap):
     flexUtil.progress_bar(0)    
     
-    backproject(projections[::samp[0],::samp[1], ::samp[2]] / (numpy.prod(samp) * geometry['img_pixel'])**4, volume, geometry, 'FDK_CUDA')
+    if slab is None:
+        backproject(projections[::samp[0],::samp[1], ::samp[2]] * numpy.float32(scale), volume, geometry, algorithm)
+        
+    else:
+        _FDK_slabs_(projections[::samp[0],::samp[1], ::samp[2]], volume, geometry, slab, algorithm, scale)
     
     flexUtil.progress_bar(1) 
+    
+def _FDK_slabs_(projections, volume, geometry, slab, algorithm = 'FDK_CUDA', scale = 1):
+    """
+    FDK of one slab of slices at a time. Peak memory is one slab plus the detector rows it projects onto.
+    """
+    proj_geom = flexData.astra_proj_geom(geometry, projections.shape)
+    
+    length = volume.shape[0]
+    
+    for z0 in range(0, length, slab):
+        
+        z1 = min(z0 + slab, length)
+        
+        # Geometry of the slab and the detector rows that see it:
+        vol_geom = flexData.astra_vol_geom(geometry, volume.shape, z0, z1 - 1)
+        r0, r1 = _detector_window_(proj_geom, vol_geom)
+        
+        block = numpy.zeros((z1 - z0,) + volume.shape[1:], dtype = 'float32')
+        
+        if r1 > r0:
+            
+            rows = numpy.multiply(projections[r0:r1], scale, dtype = 'float32')
+            
+            _backproject_block_(rows, block, _crop_rows_(proj_geom, r0, r1), vol_geom, algorithm)
+            
+        volume[z0:z1] = block
+        
+        flexUtil.progress_bar(z1 / length)
+        
+    if isinstance(volume, numpy.memmap):
+        volume.flush()
         
 def _block_index_(ii, block_number, length, mode = 'sequential'):
     """
@@ -332,237 +1660,451 @@ def _block_index_(ii, block_number, length, mode = 'sequential'):
         # Index = 0, 2, 1, 3   
         index = numpy.mod(numpy.arange(length) * block_length, length)
         
-    else:
-        raise ValueError('Indexer type not recognized! Use: sequential/random/equidistant')
+    else:
+        raise ValueError('Indexer type not recognized! Use: sequential/random/equidistant')
+    
+    first = ii * block_length
+    last = min((length + 1, (ii + 1) * block_length))
+    
+    # Sorted angles can be read from disk in fewer and longer runs:
+    return numpy.sort(index[first:last])
+
+def _index_runs_(index):
+    """
+    Split a sorted index into runs of consecutive values. Returns a list of [start, stop, position in index].
+    """
+    index = numpy.asarray(index)
+    
+    breaks = numpy.where(numpy.diff(index) != 1)[0] + 1
+    starts = numpy.concatenate(([0], breaks))
+    stops = numpy.concatenate((breaks, [index.size]))
+    
+    return [[index[a], index[b - 1] + 1, a] for a, b in zip(starts, stops)]
+    
+def _get_block_(projections, index, out = None):
+    """
+    Copy projections with given angle indexes into a contiguous block (ASTRA order).
+    If projections are stored angle-major (raw files, theta_major memmaps), each run of consecutive angles is a single contiguous read.
+    If out is given, the block is gathered into it in place.
+    """
+    index = numpy.asarray(index)
+    
+    # Is angle the slowest dimension in memory?
+    if (abs(projections.strides[1]) <= abs(projections.strides[0])) | (index.size == 0):
+        
+        if out is None:
+            return numpy.ascontiguousarray(projections[:, index, :])
+            
+        return numpy.take(projections, index, axis = 1, out = out)
+        
+    if out is None:
+        out = numpy.zeros((projections.shape[0], index.size, projections.shape[2]), dtype = projections.dtype)
+        
+    block = out
+    
+    for start, stop, pos in _index_runs_(index):
+        
+        # Read a run in the storage order, reorder it in RAM:
+        run = numpy.array(numpy.transpose(projections[:, start:stop, :], [1, 0, 2]))
+        block[:, pos:pos + stop - start, :] = numpy.transpose(run, [1, 0, 2])
+        
+    return block
+
+def _detector_window_(proj_geom, vol_geom, margin = 2, dim = 0):
+    """
+    Detector rows (dim = 0) or columns (dim = 2) [first, last) that see the volume box of vol_geom in any of the projections.
+    """
+    vectors = proj_geom['Vectors']
+    rows = proj_geom['DetectorRowCount']
+    cols = proj_geom['DetectorColCount']
+    
+    src, det, u, v = vectors[:, 0:3], vectors[:, 3:6], vectors[:, 6:9], vectors[:, 9:12]
+    
+    # Corners of the volume box:
+    option = vol_geom['option']
+    corners = numpy.array([[x, y, z] for x in [option['WindowMinX'], option['WindowMaxX']] 
+                                     for y in [option['WindowMinY'], option['WindowMaxY']] 
+                                     for z in [option['WindowMinZ'], option['WindowMaxZ']]])
+    
+    # Rays through the corners hit the detector plane at:
+    normal = numpy.cross(u, v)
+    ray = corners[None, :, :] - src[:, None, :]
+    t = ((det - src) * normal).sum(1)[:, None] / (ray * normal[:, None, :]).sum(2)
+    hit = src[:, None, :] + t[:, :, None] * ray - det[:, None, :]
+    
+    # Row or column coordinate (the projection of a box is bounded by the projections of its corners):
+    if dim == 0:
+        e = numpy.cross(u, normal)
+        e /= (v * e).sum(1)[:, None]
+        length = rows
+        
+    else:
+        e = numpy.cross(v, normal)
+        e /= (u * e).sum(1)[:, None]
+        length = cols
+        
+    coord = (hit * e[:, None, :]).sum(2) + length / 2 - 0.5
+    
+    first = int(numpy.floor(coord.min())) - margin
+    last = int(numpy.ceil(coord.max())) + 1 + margin
+    
+    return max(first, 0), min(last, length)
+    
+def _crop_rows_(proj_geom, first, last):
+    """
+    Projection geometry of the detector rows [first, last).
+    """
+    proj_geom = proj_geom.copy()
+    vectors = proj_geom['Vectors'].copy()
+    
+    # Shift the detector centre to the centre of the window:
+    shift = (first + last - 1) / 2 - (proj_geom['DetectorRowCount'] - 1) / 2
+    vectors[:, 3:6] += shift * vectors[:, 9:12]
+    
+    proj_geom['Vectors'] = vectors
+    proj_geom['DetectorRowCount'] = last - first
+    
+    return proj_geom
+    
+def _read_block_(projections, index, pool, name = 'block'):
+    """
+    Gather projections with given angle indexes into a buffer from the pool.
+    """
+    shape = (projections.shape[0], len(index), projections.shape[2])
+    
+    return _get_block_(projections, index, out = pool.get(name, shape, dtype = projections.dtype))
+    
+def _edge_taper_(rows, cols, width = 5):
+    """
+    Separable taper of the detector edges: linear decay over width pixels at both ends of rows and columns.
+    Returns an array of shape [rows, 1, cols] that can be multiplied with a block of projections.
+    """
+    taper = []
+    
+    for length in [rows, cols]:
+        
+        line = numpy.ones(length, dtype = 'float32')
+        
+        # Same as in flexData.ramp - short dimensions are left alone:
+        if (width > 0) & (length >= 2 * width):
+            line[:width] = numpy.linspace(0, 1, width)
+            line[-width:] = numpy.linspace(1, 0, width)
+            
+        taper.append(line)
+        
+    return taper[0][:, None, None] * taper[1][None, None, :]
+
+def _data_key_(array):
+    """
+    Key identifying the memory of an array (data pointer, shape and strides) that doesn't change when a new view is made.
+    """
+    return (array.__array_interface__['data'][0], array.shape, array.strides)
+    
+def _block_weight_(projections, block, index, session, poisson = False, scale = None, taper = 0, cache = True, name = 'weight'):
+    """
+    Weight of the residual of a block: Poisson weight (exp(-projections)) * scale * edge taper.
+    Computed once per block and kept in session.sensitivity while it fits in memory. Returns None if there is nothing to weight.
+    Block should contain measured projections (Poisson weight is computed from it).
+    """
+    if (not poisson) & (scale is None) & (taper == 0):
+        return None
+    
+    key = ('weight', _data_key_(projections), index.tobytes(), bool(poisson), scale, taper)
+    
+    weight = session.sensitivity.get(key) if cache else None
+    
+    if weight is not None:
+        return weight
+    
+    edge = _edge_taper_(block.shape[0], block.shape[2], taper)
+    
+    if poisson:
+        # Some formula representing the effect of photon starvation:
+        cache = cache & session.sensitivity.fits(block.nbytes)
+        
+        if cache:
+            weight = numpy.empty(block.shape, dtype = 'float32')
+        else:
+            weight = session.pool.get(name, block.shape, dtype = 'float32')
+            
+        numpy.negative(block, out = weight)
+        numpy.exp(weight, out = weight)
+        
+        weight *= edge
+        
+    else:
+        weight = edge
+        
+    if scale is not None:
+        weight *= scale
+        
+    if cache:
+        session.sensitivity.put(key, weight, persist = False)
+    
+    return weight
+    
+def _block_stream_(projections, block_number, mode, session, poisson = False, prefetch = None, copy = True, scale = None, taper = 0):
+    """
+    Yield [index, block, weight] for every block of one iteration. Weight is the residual weight of the block
+    (Poisson weight * scale * edge taper, see _block_weight_) or None.
+    With prefetch, the next block and its weight are read by a background thread while the current block 
+    is being projected (two sets of buffers are used in turns). By default prefetch is on for numpy.memmap.
+    If copy is False, a single sequential block is the projections array itself.
+    """
+    length = projections.shape[1]
+    
+    if prefetch is None:
+        prefetch = isinstance(projections, numpy.memmap)
+        
+    indexes = [_block_index_(ii, block_number, length, mode) for ii in range(block_number)]
+    indexes = [index for index in indexes if index.size > 0]
+    
+    # Random blocks are different every iteration - no point in caching their weights:
+    cache = mode != 'random'
+    
+    def read(ii):
+        
+        index = indexes[ii]
+        name = str(ii % 2) if prefetch else ''
+        
+        if (not copy) & (index.size == length) & (mode in ['sequential', None]):
+            block = projections
+        else:
+            block = _read_block_(projections, index, session.pool, 'block' + name)
+            
+        weight = _block_weight_(projections, block, index, session, poisson, scale, taper, cache, 'weight' + name)
+        
+        return index, block, weight
     
-    first = ii * block_length
-    last = min((length + 1, (ii + 1) * block_length))
+    if not prefetch:
+        for ii in range(len(indexes)):
+            yield read(ii)
+            
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(1) as executor:
+            
+            future = executor.submit(read, 0)
+            
+            for ii in range(len(indexes)):
+                
+                current = future.result()
+                
+                # Buffers of the previous block are free now:
+                if ii + 1 < len(indexes):
+                    future = executor.submit(read, ii + 1)
+                    
+                yield current
     
-    return index[first:last]
-
-def _L2_step_ctf_(projections, prj_weight, volume, geometry, options, operation = '+'):
+def _L2_step_ctf_(projections, prj_weight, volume, geometry, options, operation = '+', session = None):
     """
     A CTF version of the L2 update step.
     """
+    # Projectors and buffers:
+    with _session_(session) as session:
+        
+        # CTF, mode of indexing:
+        ctf = options.get('ctf')
+        mode = options.get('mode')
     
-    # CTF, mode of indexing:
-    ctf = options.get('ctf')
-    mode = options.get('mode')
-    
-    # How many blocks?    
-    block_number = options.get('block_number')
-    if block_number is None: block_number = 1
+        # How many blocks?    
+        block_number = options.get('block_number')
+        if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
+        # Force block number if array is numpy.memmap
+        if isinstance(projections, numpy.memmap):
+            block_number  = max((10, block_number))
         
-    length = projections.shape[1]
+        # Initialize ASTRA geometries:
+        vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
     
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+        # Residual weights are computed once per block (read in the background if options['prefetch'] is set or projections are numpy.memmap):
+        blocks = _block_stream_(projections, block_number, mode, session, options.get('poisson_weight'), options.get('prefetch'), 
+                                scale = prj_weight * block_number, taper = 5)
     
-    for ii in range(block_number):
-        
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
+        for index, block, weight in blocks:
         
-        # Copy data to a block or simply pass a pointer to data itself if block is one.
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections.copy()
-            
-        else:
-            block = (projections[:, index, :]).copy()
-            block = numpy.ascontiguousarray(block)
+            # Geometry of the block:
+            proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
         
-        # Reserve memory for a forward projection (keep it separate because of CTF application):
-        synth = numpy.ascontiguousarray(numpy.zeros_like(block))
+            # Reserve memory for a forward projection (keep it separate because of CTF application):
+            synth = session.pool.get('synth', block.shape, fill = 0)
   
-        # Forwardproject:
-        _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+')   
+            # Forwardproject:
+            _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+', session = session)   
         
-        # CTF can be applied to each projection separately:
-        synth = flexModel.apply_ctf(synth, ctf)
+            # CTF can be applied to each projection separately:
+            synth = flexModel.apply_ctf(synth, ctf)
 
-        # Compute residual:        
-        block = (block - synth)
+            # Compute residual:        
+            block -= synth
     
-        # Take into account Poisson:
-        if options.get('poisson_weight'):
-            # Some formula representing the effect of photon starvation...
-            #block *= numpy.sqrt(numpy.exp(-projections[:, index, :]))               
-            block *= numpy.exp(-projections[:, index, :])
-            
-        block *= prj_weight * block_number
-        
-        # Apply ramp to reduce boundary effects:
-        block = block = flexData.ramp(block, 2, 5, mode = 'linear')
-        block = block = flexData.ramp(block, 0, 5, mode = 'linear')
+            # Poisson weight, prj_weight and a taper to reduce boundary effects (precomputed):
+            block *= weight
                 
-        # L2 norm (use the last block to update):
-        if options.get('l2_update'):
-            l2 = (numpy.sqrt((block ** 2).mean()))
+            # L2 norm (use the last block to update):
+            if options.get('l2_update'):
+                l2 = (numpy.sqrt((block ** 2).mean()))
             
-        else:
-            l2 = 0 
+            else:
+                l2 = 0 
           
-        # Project
-        _backproject_block_(block, volume, proj_geom, vol_geom, 'BP3D_CUDA', operation)    
+            # Project
+            _backproject_block_(block, volume, proj_geom, vol_geom, 'BP3D_CUDA', operation, session = session)    
     
-    # Apply bounds
-    if options.get('bounds') is not None:
-        numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        # Apply bounds
+        if options.get('bounds') is not None:
+            numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        
+        # Voxels outside of the support (see find_support) are zero:
+        if options.get('support') is not None:
+            volume *= options['support']
 
+    
     return l2   
     
-def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+'):
+def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+', session = None):
     """
     Update volume: single SIRT step.
+    With options['normalize'], residuals are weighted by inverse row sums and updates by inverse column sums of each block.
     """
+    # Projectors and buffers:
+    with _session_(session) as session:
+        
+        # Mode of indexing, SIRT normalization with true row and column sums instead of prj_weight:
+        mode = options.get('mode')
+        normalize = options.get('normalize')
     
-    # Mode of indexing:
-    mode = options.get('mode')
-    
-    # How many blocks?    
-    block_number = options.get('block_number')
-    if block_number is None: block_number = 1
+        # How many blocks?    
+        block_number = options.get('block_number')
+        if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
+        # Force block number if array is numpy.memmap
+        if isinstance(projections, numpy.memmap):
+            block_number  = max((10, block_number))
         
-    length = projections.shape[1]
+        # Initialize ASTRA geometries:
+        vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
     
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+        l2 = 0
     
-    l2 = 0
+        # Residual weights are computed once per block (read in the background if options['prefetch'] is set or projections are numpy.memmap):
+        scale = None if normalize else prj_weight * block_number
+        blocks = _block_stream_(projections, block_number, mode, session, options.get('poisson_weight'), options.get('prefetch'), 
+                                scale = scale, taper = 5)
     
-    for ii in range(block_number):
+        for index, block, weight in blocks:
         
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
+            # Geometry of the block:
+            proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
         
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections.copy()
-            #block = projections
-            
-        else:
-            block = (projections[:, index, :]).copy()
-            block = numpy.ascontiguousarray(block)
-                
-        # Forwardproject:
-        _forwardproject_block_(block, volume, proj_geom, vol_geom, '-')   
+            # Forwardproject:
+            _forwardproject_block_(block, volume, proj_geom, vol_geom, '-', session = session)   
                     
-        # Take into account Poisson:
-        if options.get('poisson_weight'):
-            
-            # Some formula representing the effect of photon starvation...
-            block *= numpy.exp(-projections[:, index, :])
+            # Poisson weight, prj_weight and a taper to reduce boundary effects (precomputed):
+            block *= weight
             
-        block *= prj_weight * block_number
-        
-        # Apply ramp to reduce boundary effects:
-        block = flexData.ramp(block, 0, 5, mode = 'linear')
-        block = flexData.ramp(block, 2, 5, mode = 'linear')
+            if normalize:
+                # Weight residual with inverse row sums:
+                block *= session.sensitivity.rows(proj_geom, vol_geom, session, inverse = True)
                 
-        # L2 norm (use the last block to update):
-        if options.get('l2_update'):
-            l2 = (numpy.sqrt((block ** 2).mean()))
+            # L2 norm (use the last block to update):
+            if options.get('l2_update'):
+                l2 = (numpy.sqrt((block ** 2).mean()))
           
-        # Project
-        _backproject_block_(block, volume, proj_geom, vol_geom, 'BP3D_CUDA', operation)    
+            # Project
+            if normalize:
+                # Update is weighted with inverse column sums of the block:
+                update = session.pool.get('update', volume.shape, fill = 0)
+                _backproject_block_(block, update, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)    
+            
+                update *= session.sensitivity.columns(proj_geom, vol_geom, session, inverse = True)
+            
+                if operation == '-':
+                    volume -= update
+                else:
+                    volume += update
+            
+            else:
+                _backproject_block_(block, volume, proj_geom, vol_geom, 'BP3D_CUDA', operation, session = session)    
     
-    # Apply bounds
-    if options.get('bounds') is not None:
-        numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        # Apply bounds
+        if options.get('bounds') is not None:
+            numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        
+        # Voxels outside of the support (see find_support) are zero:
+        if options.get('support') is not None:
+            volume *= options['support']
 
+    
     return l2   
     
-def _fista_step_(projections, prj_weight, vol, vol_old, vol_t, t, geometry, options):
+def _fista_step_(projections, prj_weight, vol, vol_d, vol_t, t, geometry, options, session = None):
     """
-    Update volume: single SIRT step.
+    Update volume: single FISTA step. Blocks make a SIRT sweep from the extrapolated point, momentum is updated once per sweep.
+    vol is the current solution, vol_t is the extrapolated point (gradients are computed there), vol_d is a buffer
+    for the difference between two solutions. All are updated in place. Returns [l2, t].
     """
+    # Projectors and buffers:
+    with _session_(session) as session:
+        
+        # Mode of indexing:
+        mode = options.get('mode')
+        bounds = options.get('bounds')
     
-    # Mode of indexing:
-    mode = options.get('mode')
-    
-    # How many blocks?    
-    block_number = options.get('block_number')
-    if block_number is None: block_number = 1
+        # How many blocks?    
+        block_number = options.get('block_number')
+        if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
+        # Force block number if array is numpy.memmap
+        if isinstance(projections, numpy.memmap):
+            block_number  = max((10, block_number))
         
-    length = projections.shape[1]
-    
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, vol.shape)      
+        # Initialize ASTRA geometries:
+        vol_geom = flexData.astra_vol_geom(geometry, vol.shape)      
     
-    vol_old[:] = vol.copy()  
+        l2 = 0
     
-    t_old = t 
-    t = (1 + numpy.sqrt(1 + 4 * t**2))/2
-
-    vol[:] = vol_t.copy()
+        # Residual weights are computed once per block (read in the background if options['prefetch'] is set or projections are numpy.memmap):
+        blocks = _block_stream_(projections, block_number, mode, session, options.get('poisson_weight'), options.get('prefetch'), 
+                                scale = prj_weight * block_number, taper = 5)
     
-    for ii in range(block_number):
+        for index, block, weight in blocks:
         
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
+            # Geometry of the block:
+            proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
         
-        # Copy data to a block or simply pass a pointer to data itself if block is one.
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections.copy()
-            
-        else:
-            block = (projections[:, index, :]).copy()
-            block = numpy.ascontiguousarray(block)
-                
-        # Forwardproject:
-        _forwardproject_block_(block, vol_t, proj_geom, vol_geom, '-')   
+            # Forwardproject the extrapolated point:
+            _forwardproject_block_(block, vol_t, proj_geom, vol_geom, '-', session = session)   
                     
-        # Take into account Poisson:
-        if options.get('poisson_weight'):
-            # Some formula representing the effect of photon starvation...
-            block *= numpy.exp(-projections[:, index, :])
-            
-        block *= prj_weight * block_number
-        
-        # Apply ramp to reduce boundary effects:
-        block = block = flexData.ramp(block, 2, 5, mode = 'linear')
-        block = block = flexData.ramp(block, 0, 5, mode = 'linear')
+            # Poisson weight, prj_weight and a taper to reduce boundary effects (precomputed):
+            block *= weight
                 
-        # L2 norm (use the last block to update):
-        if options.get('l2_update'):
-            l2 = (numpy.sqrt((block ** 2).mean()))
-            
-        else:
-            l2 = 0 
+            # L2 norm (use the last block to update):
+            if options.get('l2_update'):
+                l2 = (numpy.sqrt((block ** 2).mean()))
           
-        # Project
-        _backproject_block_(block, vol, proj_geom, vol_geom, 'BP3D_CUDA', '+')   
+            # Gradient step from the extrapolated point. vol_t becomes the new solution:
+            _backproject_block_(block, vol_t, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)   
         
-        vol_t[:] = vol + ((t_old - 1) / t) * (vol - vol_old)
+            # Bounds are the proximal operator:
+            if bounds is not None:
+                numpy.clip(vol_t, a_min = bounds[0], a_max = bounds[1], out = vol_t) 
+        
+        # Momentum:
+        t_old = t 
+        t = (1 + numpy.sqrt(1 + 4 * t**2))/2
+    
+        # vol_t = vol_new + (t_old - 1) / t * (vol_new - vol), vol = vol_new:
+        numpy.subtract(vol_t, vol, out = vol_d)
+        vol[:] = vol_t
+    
+        vol_d *= (t_old - 1) / t
+        vol_t += vol_d
                 
-    # Apply bounds
-    if options.get('bounds') is not None:
-        numpy.clip(vol, a_min = options['bounds'][0], a_max = options['bounds'][1], out = vol) 
-
-    return l2  
+    
+    return l2, t
     
 '''
 # Forward:
@@ -580,81 +2122,113 @@ def _fista_step_(projections, prj_weight, vol, vol_old, vol_t, t, geometry, opti
     vol_t = x + ((t_old - 1) / t) * (vol - vol_old)
 '''    
 
-def _em_step_(projections, prj_weight, volume, geometry, options):
+def _em_step_(projections, prj_weight, volume, geometry, options, session = None):
     """
     Update volume: single EM step.
     """
+    # Projectors and buffers:
+    with _session_(session) as session:
+        
+        # CTF, mode of indexing:
+        ctf = options.get('ctf')
+        mode = options.get('mode')
     
-    # CTF, mode of indexing:
-    ctf = options.get('ctf')
-    mode = options.get('mode')
-    
-    # How many blocks?    
-    block_number = options.get('block_number')
-    if block_number is None: block_number = 1
+        # How many blocks?    
+        block_number = options.get('block_number')
+        if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
+        # Force block number if array is numpy.memmap
+        if isinstance(projections, numpy.memmap):
+            block_number  = max((10, block_number))
         
-    length = projections.shape[1]
+        # Initialize ASTRA geometries:
+        vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
     
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+        # Blocks are read (and weighted) in the background if options['prefetch'] is set or projections are numpy.memmap:
+        blocks = _block_stream_(projections, block_number, mode, session, options.get('poisson_weight'), options.get('prefetch'), copy = False)
     
-    for ii in range(block_number):
-        
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
+        for index, block, weight in blocks:
         
-        # Copy data to a block or simply pass a pointer to data itself if block is one.
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections
-            
-        else:
-            block = (projections[:, index, :]).copy()
+            # Geometry of the block:
+            proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
         
-        # Reserve memory for a forward projection (keep it separate):
-        synth = numpy.ascontiguousarray(numpy.zeros_like(block))
+            # Reserve memory for a forward projection (keep it separate):
+            synth = session.pool.get('synth', block.shape, fill = 0)
         
-        # Forwardproject:
-        _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+')   
+            # Forwardproject:
+            _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+', session = session)   
   
-        # CTF can be applied to each projection separately:
-        if ctf is not None:
-            synth = flexModel.apply_ctf(synth, ctf)
+            # CTF can be applied to each projection separately:
+            if ctf is not None:
+                synth = flexModel.apply_ctf(synth, ctf)
 
-        # Compute residual:        
-        synth[synth < 1e-10] = numpy.inf  
-        synth = (block / synth)
+            # Compute residual:        
+            synth[synth < 1e-10] = numpy.inf  
+            numpy.divide(block, synth, out = synth)
                     
-        # L2 norm (use the last block to update):
-        if options.get('l2_update'):
+            # L2 norm (use the last block to update):
+            if options.get('l2_update'):
             
-            _synth = synth[synth > 0]
-            l2 = _synth.std()
+                _synth = synth[synth > 0]
+                l2 = _synth.std()
             
-        else:
-            l2 = [] 
+            else:
+                l2 = [] 
           
-        # Project
-        _backproject_block_(synth * prj_weight * block_number, volume, proj_geom, vol_geom, 'BP3D_CUDA', '*')    
+            # Project (the update is normalized by the column sums of this block):
+            synth *= prj_weight
+            _backproject_block_(synth, volume, proj_geom, vol_geom, 'BP3D_CUDA', '*', session = session)    
     
-    # Apply bounds
-    if options.get('bounds') is not None:
-        numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        # Apply bounds
+        if options.get('bounds') is not None:
+            numpy.clip(volume, a_min = options['bounds'][0], a_max = options['bounds'][1], out = volume) 
+        
+        # Voxels outside of the support (see find_support) are zero:
+        if options.get('support') is not None:
+            volume *= options['support']
 
+    
     return l2    
            
+def _brick_map_(volume, options):
+    """
+    Occupancy map for options['bricks'] (True or the brick size), restricted to options['support'] if given.
+    """
+    size = options['bricks'] if options['bricks'] is not True else 32
+    
+    bricks = BrickMap(volume.shape, size)
+    
+    if options.get('support') is not None:
+        bricks.restrict(options['support'])
+        
+    return bricks
+    
+def _update_bricks_(session, *volumes):
+    """
+    Deactivate bricks that stay at zero, make sure inactive bricks are zero.
+    """
+    if session.bricks is None: return
+    
+    session.bricks.update(volumes[0])
+    
+    for volume in volumes:
+        session.bricks.clear(volume)
+        
 def SIRT(projections, volume, geometry, iterations, options = {'poisson_weight': False, 'l2_update': True, 'preview':False, 'bounds':None, 'block_number':10, 'mode':'sequential', 'ctf': None}):
     """
     SIRT
     CTF is only applied in the blocky version of SIRT!
+    Use options['normalize'] for SIRT with true row and column sums (cached per block, 
+    stored in options['sensitivity_path'] if given).
+    Use options['roi'] to reconstruct a box in mm from the detector window that sees it (see roi_geometry,
+    material outside of the box is estimated with voxels options['roi_sample'] times larger, 2 by default)
+    and options['support'] to keep voxels outside of a support mask at zero (see find_support).
+    Use options['bricks'] (True or brick size) to skip bricks of the volume that stay at zero (see BrickMap).
     """     
+    # Region of interest:
+    if options.get('roi') is not None:
+        projections, geometry = _apply_roi_(projections, volume, geometry, options['roi'], exterior = options.get('roi_sample', 2))
+        
     # Sampling:
     samp = geometry['sample']
     anisotropy = geometry['anisotropy']
@@ -669,25 +2243,42 @@ def SIRT(projections, volume, geometry, iterations, options = {'poisson_weight':
     print('Feeling SIRTy...')
     
     flexUtil.progress_bar(0)
+    
+    # Projectors and sensitivity images are reused by all iterations:
+    with ProjectorSession(sensitivity_path = options.get('sensitivity_path')) as session:
+    
+        # Empty space skipping:
+        if options.get('bricks'):
+            session.bricks = _brick_map_(volume, options)
         
-    for ii in range(iterations):
+        for ii in range(iterations):
     
-        # Update volume:
-        l2_  = _L2_step_(projections[::samp[0], ::samp[1], ::samp[2]], prj_weight, volume, geometry, options)
-        l2.append(l2_)
+            # Update volume:
+            l2_  = _L2_step_(projections[::samp[0], ::samp[1], ::samp[2]], prj_weight, volume, geometry, options, session = session)
+            l2.append(l2_)
+        
+            # Bricks that stay at zero are skipped:
+            _update_bricks_(session, volume)
                     
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 1)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 1)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
+    
     if options.get('l2_update'):   
          flexUtil.plot(l2, semilogy = True, title = 'Resudual L2')   
          
 def FISTA(projections, volume, geometry, iterations, options = {'poisson_weight': False, 'l2_update': True, 'preview':False, 'bounds':None, 'block_number':10, 'mode':'sequential', 'ctf': None}):
+    """
+    FISTA - SIRT with Nesterov momentum. Needs fewer iterations than SIRT for the same result.
+    Takes the same options as SIRT (except ctf and normalize). Bounds are applied after every block.
+    Use options['bricks'] (True or brick size) to skip bricks of the volume that stay at zero (see BrickMap).
+    """
     # Sampling:
     samp = geometry['sample']
+    anisotropy = geometry['anisotropy']
     
     pix = (geometry['img_pixel']**4 * anisotropy[0] * anisotropy[1] * anisotropy[2] * anisotropy[2])
     prj_weight = 1 / (projections[::samp[0], ::samp[1], ::samp[2]].shape[1] * pix * max(volume.shape)) 
@@ -696,28 +2287,241 @@ def FISTA(projections, volume, geometry, iterations, options = {'poisson_weight'
     l2 = []   
     t = 1
     
+    # Extrapolated point and a buffer for the difference of solutions:
     volume_t = volume.copy()
-    volume_old = volume.copy()
+    volume_d = numpy.zeros(volume.shape, dtype = 'float32')
 
     print('FISTING in progress...')
     
     flexUtil.progress_bar(0)
+    
+    # Projectors and residual weights are reused by all iterations:
+    with ProjectorSession() as session:
+    
+        # Empty space skipping:
+        if options.get('bricks'):
+            session.bricks = _brick_map_(volume, options)
         
-    for ii in range(iterations):
+        for ii in range(iterations):
     
-        # Update volume:
-        l2_  = _fista_step_(projections[::samp[0], ::samp[1], ::samp[2]], prj_weight, volume, volume_old, volume_t, t, geometry, options)
-        l2.append(l2_)
+            # Update volume:
+            l2_, t = _fista_step_(projections[::samp[0], ::samp[1], ::samp[2]], prj_weight, volume, volume_d, volume_t, t, geometry, options, session = session)
+            l2.append(l2_)
         
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Bricks that stay at zero are skipped:
+            _update_bricks_(session, volume, volume_t)
+        
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 1)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
+    
     if options.get('l2_update'):   
         flexUtil.plot(l2, semilogy = True, title = 'Resudual L2')   
 
+def _cgls_buffer_(projections):
+    """
+    Buffer of the shape of projections for CGLS. If projections are numpy.memmap, so is the buffer (in a temporary file).
+    """
+    if isinstance(projections, numpy.memmap):
+        import tempfile
+        return numpy.memmap(tempfile.TemporaryFile(), dtype = 'float32', mode = 'w+', shape = projections.shape)
+    
+    else:
+        return numpy.zeros(projections.shape, dtype = 'float32')
+    
+def _squared_norm_(array):
+    """
+    Sum of squares of a float32 array, accumulated in float64.
+    """
+    array = array.ravel()
+    
+    return numpy.einsum('i,i->', array, array, dtype = 'float64')
+    
+def CGLS(projections, volume, geometry, iterations, options = {'l2_update': True, 'preview':False, 'block_number':10}):
+    """
+    CGLS - conjugate gradient least squares. Converges much faster than SIRT for complete data (no bounds, no Poisson weight).
+    Projectors are applied in blocks of options['block_number'] projections. Residual and search direction in the projection
+    space are numpy.memmap (temporary files) if projections are numpy.memmap.
+    Returns the L2 norm of the residual at every iteration.
+    """
+    # Sampling:
+    samp = geometry['sample']
+    anisotropy = geometry['anisotropy']
+    
+    projections = projections[::samp[0], ::samp[1], ::samp[2]]
+    
+    # Backprojector is the adjoint of the forward projector times voxel_size^2:
+    pix = (geometry['img_pixel']**3 * anisotropy[0] * anisotropy[1] * anisotropy[2]) ** (2/3)
+    
+    # How many blocks?    
+    block_number = options.get('block_number')
+    if block_number is None: block_number = 1
+    
+    # Force block number if array is numpy.memmap
+    if isinstance(projections, numpy.memmap):
+        block_number  = max((10, block_number))
+        
+    length = projections.shape[1]
+    indexes = [_block_index_(ii, block_number, length, 'sequential') for ii in range(block_number)]
+    indexes = [index for index in indexes if index.size > 0]
+    
+    # Initialize ASTRA geometries:
+    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+    proj_geoms = [flexData.astra_proj_geom(geometry, projections.shape, index = index) for index in indexes]
+    
+    # Residual, its backprojection and the search directions:
+    residual = _cgls_buffer_(projections)
+    direction_prj = _cgls_buffer_(projections)
+    
+    gradient = numpy.zeros(volume.shape, dtype = 'float32')
+    direction = numpy.zeros(volume.shape, dtype = 'float32')
+    
+    # Initialize L2:
+    l2 = []   
+    
+    print('CGLS-ing in progress...')
+    
+    flexUtil.progress_bar(0)
+    
+    # Projectors are reused by all iterations:
+    with ProjectorSession() as session:
+    
+        # residual = projections - A * volume, gradient = A' * residual:
+        for index, proj_geom in zip(indexes, proj_geoms):
+        
+            block = _read_block_(projections, index, session.pool)
+            _forwardproject_block_(block, volume, proj_geom, vol_geom, '-', session = session)
+        
+            residual[:, index, :] = block
+            _backproject_block_(block, gradient, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
+        
+        gradient /= pix
+        direction[:] = gradient
+    
+        gamma = _squared_norm_(gradient)
+        
+        for ii in range(iterations):
+        
+            # Forward project the search direction: 
+            norm = 0
+        
+            for index, proj_geom in zip(indexes, proj_geoms):
+            
+                block = session.pool.get('block', (projections.shape[0], index.size, projections.shape[2]), fill = 0)
+                _forwardproject_block_(block, direction, proj_geom, vol_geom, '+', session = session)
+            
+                direction_prj[:, index, :] = block
+                norm += _squared_norm_(block)
+            
+            # Nothing left to improve:
+            if (norm == 0) | (gamma == 0):
+                flexUtil.progress_bar(1)
+                break
+        
+            alpha = gamma / norm
+        
+            # Update volume, residual and its backprojection:
+            volume += alpha * direction
+        
+            gradient[:] = 0
+            res_norm = 0
+        
+            for index, proj_geom in zip(indexes, proj_geoms):
+            
+                block = _read_block_(residual, index, session.pool)
+                block -= alpha * direction_prj[:, index, :]
+            
+                residual[:, index, :] = block
+                res_norm += _squared_norm_(block)
+            
+                _backproject_block_(block, gradient, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
+            
+            gradient /= pix
+        
+            gamma_old = gamma
+            gamma = _squared_norm_(gradient)
+        
+            # New search direction:
+            direction *= gamma / gamma_old
+            direction += gradient
+        
+            l2.append(numpy.sqrt(res_norm / residual.size))
+        
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 1)
+            
+            flexUtil.progress_bar((ii+1) / iterations)
+        
+    
+    if options.get('l2_update'):   
+        flexUtil.plot(l2, semilogy = True, title = 'Resudual L2')   
+        
+    return l2
+    
+def _level_geometry_(geometry, theta_count, level):
+    """
+    Geometry of a subsampled problem: detector, angles and voxels are coarser by a factor of level.
+    """
+    geometry_ = geometry.copy()
+    
+    geometry_['sample'] = [x * level for x in geometry['sample']]
+    geometry_['anisotropy'] = [x * level for x in geometry['anisotropy']]
+    
+    # Every level-th angle of the sampled projections (exactly the ones that will be used):
+    thetas = geometry.get('_thetas_')
+    
+    if thetas is None:
+        thetas = numpy.linspace(geometry.get('theta_min'), geometry.get('theta_max'), theta_count, dtype = 'float32')
+        
+    geometry_['_thetas_'] = numpy.asarray(thetas)[::geometry['sample'][1]][::level]
+    
+    return geometry_
+    
+def multiresolution(projections, volume, geometry, iterations, method = 'sirt', options = {'l2_update': False, 'block_number':10, 'mode':'sequential'}, levels = [4, 2, 1]):
+    """
+    Coarse-to-fine reconstruction. Each level is reconstructed with detector, angles and voxels subsampled 
+    by a factor of level and is used (upsampled) as the initial volume of the next level.
+    
+    Args:
+        iterations : number of iterations at full resolution. Level n gets iterations * n (they are ~n^3 times cheaper).
+        method     : 'sirt', 'fista', 'em' or 'cgls'
+        options    : options of the method
+        levels     : subsampling factors, the last one should be 1
+    """
+    from scipy import ndimage
+    
+    solver = {'sirt': SIRT, 'fista': FISTA, 'em': EM, 'cgls': CGLS}[method.lower()]
+    
+    # Current initial volume:
+    init = volume
+    
+    for level in levels:
+        
+        print('Resolution level: %u' % level)
+        
+        if level == 1:
+            vol = volume
+            geometry_ = geometry
+            
+        else:
+            shape = [int(numpy.ceil(x / level)) for x in volume.shape]
+            vol = numpy.zeros(shape, dtype = 'float32')
+            
+            geometry_ = _level_geometry_(geometry, projections.shape[1], level)
+            
+        # Upsample (or downsample) the previous level:
+        if init is not vol:
+            zoom = [x / y for x, y in zip(vol.shape, init.shape)]
+            vol[:] = ndimage.zoom(init, zoom, order = 1, output = 'float32', mode = 'nearest', grid_mode = True)
+            
+        solver(projections, vol, geometry_, iterations * level, options)
+        
+        init = vol
+        
 def SIRT_tiled(projections, volume, geometries, iterations, options = {'poisson_weight': False, 'l2_update': True, 'preview':False, 'bounds':None, 'block_number':1, 'mode':'sequential', 'ctf': None}):
     """
     SIRT: tiled version.
@@ -742,29 +2546,33 @@ def SIRT_tiled(projections, volume, geometries, iterations, options = {'poisson_
     print('Doing SIRT`y things...')
     
     flexUtil.progress_bar(0)
+    
+    # Projectors of all tiles and sensitivity images are reused by all iterations:
+    with ProjectorSession(sensitivity_path = options.get('sensitivity_path')) as session:
         
-    for ii in range(iterations):
+        for ii in range(iterations):
         
-        l2_ = 0
-        for ii, proj in enumerate(projections):
+            l2_ = 0
+            for ii, proj in enumerate(projections):
             
-            geom = geometries_[ii]
+                geom = geometries_[ii]
 
-            #m = (geom['src2obj'] + geom['det2obj']) / geom['src2obj']
-            # This weight is half of the normal weight to make sure convergence is ok:
-            prj_weight = 1 / (proj.shape[1] * (geom['img_pixel']) ** 4 * max(volume.shape)) 
+                #m = (geom['src2obj'] + geom['det2obj']) / geom['src2obj']
+                # This weight is half of the normal weight to make sure convergence is ok:
+                prj_weight = 1 / (proj.shape[1] * (geom['img_pixel']) ** 4 * max(volume.shape)) 
     
-            # Update volume:
-            l2_ += _L2_step_(proj, prj_weight, volume, geom, options)
+                # Update volume:
+                l2_ += _L2_step_(proj, prj_weight, volume, geom, options, session = session)
             
-        l2.append(l2_)
+            l2.append(l2_)
                     
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
+    
     if options.get('l2_update'):   
         flexUtil.plot(l2, semilogy = True, title = 'Resudual L2')      
          
@@ -784,84 +2592,113 @@ def PWLS_M(projections, volume, geometries, n_iter = 10, block_number = 20, stud
     
     # reconstruction volume:
     ring = numpy.zeros([projsh[0], projsh[1]], dtype = 'float32')
+    
+    # Update buffers are reused by all blocks, so their links stay valid in the session:
+    vol_tmp = numpy.zeros_like(volume)
+    bwp_w = numpy.zeros_like(volume)
+    
+    # Projectors and backprojected weights are reused by all iterations:
+    with ProjectorSession() as session:
+    
+        # Blocks are random subsets of angles drawn once, so that their weights can be cached:
+        orders = [numpy.random.permutation(projs.shape[1]) for projs in projections]
         
-    # Iterations:
-    for ii in range(n_iter):
+        # Iterations:
+        for ii in range(n_iter):
     
-        # Error:
-        L_mean = 0
+            # Error:
+            L_mean = 0
         
-        #Blocks:
-        for jj in range(block_number):        
+            #Blocks:
+            for jj in range(block_number):        
+            
+                # Volume update:
+                vol_tmp[:] = 0
+            
+                # Backprojected weights only depend on the data:
+                key = ('pwls', jj, block_number, weight_power, pwls & ~ student)
+                bwp_cached = session.sensitivity.get(key)
             
-            # Volume update:
-            vol_tmp = numpy.zeros_like(volume)
-            bwp_w = numpy.zeros_like(volume)
+                if bwp_cached is None:
+                    bwp_w[:] = 0
             
-            for jj, projs in enumerate(projections):
-                index = _block_index_(jj, block_number, projs.shape[1], 'random')
+                for kk, projs in enumerate(projections):
+                    index = numpy.sort(orders[kk][_block_index_(jj, block_number, projs.shape[1])])
     
-                proj = numpy.ascontiguousarray(projs[:,index,:])
-                geom = geometries[jj]
+                    proj = _read_block_(projs, index, session.pool)
+                    geom = geometries[kk]
 
-                proj_geom = flexData.astra_proj_geom(geom, projs.shape, index = index) 
-                vol_geom = flexData.astra_vol_geom(geom, volume.shape) 
+                    proj_geom = flexData.astra_proj_geom(geom, projs.shape, index = index) 
+                    vol_geom = flexData.astra_vol_geom(geom, volume.shape) 
             
-                prj_tmp = numpy.zeros_like(proj)
+                    prj_tmp = session.pool.get('synth', proj.shape, fill = 0)
                 
-                # Compute weights:
-                if pwls & ~ student:
-                    fwp_w = numpy.exp(-proj * weight_power)
+                    # Compute weights:
+                    if pwls & ~ student:
+                        fwp_w = session.pool.get('weight', proj.shape)
+                        numpy.multiply(proj, -weight_power, out = fwp_w)
+                        numpy.exp(fwp_w, out = fwp_w)
                     
-                else:
-                    fwp_w = numpy.ones_like(proj)
+                    else:
+                        fwp_w = session.pool.get('weight', proj.shape, fill = 1)
                                         
-                #fwp_w = scipy.ndimage.morphology.grey_erosion(fwp_w, size=(3,1,3))
+                    #fwp_w = scipy.ndimage.morphology.grey_erosion(fwp_w, size=(3,1,3))
                 
-                _backproject_block_(fwp_w, bwp_w, proj_geom, vol_geom, 'BP3D_CUDA', '+')
+                    if bwp_cached is None:
+                        _backproject_block_(fwp_w, bwp_w, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
                 
-                #flex.project.backproject(fwp_w, bwp_w, geom)  
-                _forwardproject_block_(prj_tmp, volume, proj_geom, vol_geom, '+') 
-                #flex.project.forwardproject(prj_tmp, volume, geom)
+                    #flex.project.backproject(fwp_w, bwp_w, geom)  
+                    _forwardproject_block_(prj_tmp, volume, proj_geom, vol_geom, '+', session = session) 
+                    #flex.project.forwardproject(prj_tmp, volume, geom)
             
-                if rings_t == 0:
-                    prj_tmp = (proj - prj_tmp) * fwp_w / fac
+                    if rings_t == 0:
+                        numpy.subtract(proj, prj_tmp, out = prj_tmp)
+                        prj_tmp *= fwp_w
+                        prj_tmp /= fac
 
-                    #flex.util.display_slice(prj_tmp,dim=1, title='pre')
-                    if student:
-                        prj_tmp = studentst(prj_tmp, 5)
+                        #flex.util.display_slice(prj_tmp,dim=1, title='pre')
+                        if student:
+                            prj_tmp = studentst(prj_tmp, 5)
                     
-                else:
-                    # Add rings removal:
-                    # Residual:                                
-                    prj_tmp = (proj + ring[:,None,:] - prj_tmp) * fwp_w / fac
+                    else:
+                        # Add rings removal:
+                        # Residual:                                
+                        numpy.subtract(proj, prj_tmp, out = prj_tmp)
+                        prj_tmp += ring[:,None,:]
+                        prj_tmp *= fwp_w
+                        prj_tmp /= fac
                     
-                    # Update rings:
-                    me = prj_tmp.mean(1) * 2
-                    #rec -= me
-                    ring -= (me - scipy.signal.medfilt(me, 5)) 
+                        # Update rings:
+                        me = prj_tmp.mean(1) * 2
+                        #rec -= me
+                        ring -= (me - scipy.signal.medfilt(me, 5)) 
                     
-                    ring = ring - ring.mean()
-                    ring = numpy.maximum(numpy.abs(ring)-rings_t, 0) * numpy.sign(ring)
+                        ring = ring - ring.mean()
+                        ring = numpy.maximum(numpy.abs(ring)-rings_t, 0) * numpy.sign(ring)
                     
                     
-                _backproject_block_(prj_tmp, vol_tmp, proj_geom, vol_geom, 'BP3D_CUDA', '+')
+                    _backproject_block_(prj_tmp, vol_tmp, proj_geom, vol_geom, 'BP3D_CUDA', '+', session = session)
                 
-                # Mean L for projection
-                L_mean += (prj_tmp**2).mean() 
+                    # Mean L for projection
+                    L_mean += (prj_tmp**2).mean() 
                 
-            eps = bwp_w.max() / 100    
-            bwp_w[bwp_w < eps] = eps
+                if bwp_cached is None:
+                    eps = bwp_w.max() / 100    
+                    bwp_w[bwp_w < eps] = eps
                 
-            volume += vol_tmp / bwp_w
-            volume[volume < 0] = 0
+                    bwp_cached = session.sensitivity.put(key, bwp_w.copy(), persist = False)
+                
+                vol_tmp /= bwp_cached
+                volume += vol_tmp
+                volume[volume < 0] = 0
 
-            #print((volume<0).sum())
+                #print((volume<0).sum())
                 
-        L.append(L_mean / block_number / len(projections))
+            L.append(L_mean / block_number / len(projections))
+        
+            #flex.util.display_slice(vol_rec, title = 'Iter')
+            flexUtil.progress_bar((ii+1)/n_iter)
         
-        #flex.util.display_slice(vol_rec, title = 'Iter')
-        flexUtil.progress_bar((ii+1)/n_iter)
         
     flexUtil.plot(numpy.array(L), semilogy=True)
     
@@ -870,7 +2707,19 @@ def PWLS_M(projections, volume, geometries, n_iter = 10, block_number = 20, stud
 def EM(projections, volume, geometry, iterations, options = {'preview':False, 'bounds':None, 'block_number':1, 'mode':'sequential', 'l2_update': True}):
     """
     Expectation Maximization
+    Use options['roi'] to reconstruct a box in mm from the detector window that sees it (see roi_geometry,
+    material outside of the box is estimated with voxels options['roi_sample'] times larger, 2 by default)
+    and options['support'] to keep voxels outside of a support mask at zero (see find_support).
+    Use options['bricks'] (True or brick size) to skip bricks of the volume that stay at zero (see BrickMap).
     """ 
+    # Region of interest:
+    if options.get('roi') is not None:
+        projections, geometry = _apply_roi_(projections, volume, geometry, options['roi'], exterior = options.get('roi_sample', 2))
+        
+    # Sampling:
+    samp = geometry['sample']
+    projections = projections[::samp[0], ::samp[1], ::samp[2]]
+    
     # Make sure array is contiguous (if not memmap):
     #if not isinstance(projections, numpy.memmap):
      #   projections = numpy.ascontiguousarray(projections)    
@@ -889,25 +2738,36 @@ def EM(projections, volume, geometry, iterations, options = {'preview':False, 'b
     print('Em Emm Emmmm...')
     
     flexUtil.progress_bar(0)
+    
+    # Projectors and sensitivity images are reused by all iterations:
+    with ProjectorSession(sensitivity_path = options.get('sensitivity_path')) as session:
+    
+        # Empty space skipping:
+        if options.get('bricks'):
+            session.bricks = _brick_map_(volume, options)
         
-    for ii in range(iterations):
+        for ii in range(iterations):
 
-        # Temp projection data
-        #forwardproject(projections, volume, geometry, operation = '/')
+            # Temp projection data
+            #forwardproject(projections, volume, geometry, operation = '/')
                 
-        # Temp reconstruction volume        
-        #backproject(projections, volume, geometry, 'BP3D_CUDA', operation = '*')    
+            # Temp reconstruction volume        
+            #backproject(projections, volume, geometry, 'BP3D_CUDA', operation = '*')    
+        
+            # Update volume:
+            l2_  = _em_step_(projections, 1, volume, geometry, options, session = session)
+            l2.append(l2_)
         
-        # Update volume:
-        l2_  = _em_step_(projections, 1, volume, geometry, options)
-        l2.append(l2_)
+            # Bricks that stay at zero are skipped:
+            _update_bricks_(session, volume)
                     
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
                         
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
+    
     if options.get('l2_update'):
         flexUtil.plot(l2, semilogy = True, title = 'Resudual L2')   
 
@@ -939,25 +2799,29 @@ def EM_tiled(projections, volume, geometries, iterations, options = {'poisson_we
     print('Em Emm Emmmm...')
     
     flexUtil.progress_bar(0)
+    
+    # Projectors of all tiles and sensitivity images are reused by all iterations:
+    with ProjectorSession(sensitivity_path = options.get('sensitivity_path')) as session:
         
-    for ii in range(iterations):
+        for ii in range(iterations):
         
-        #l2_ = 0
-        for ii, proj in enumerate(projections):
+            #l2_ = 0
+            for ii, proj in enumerate(projections):
             
-            geom = geometries_[ii]
+                geom = geometries_[ii]
 
-            # Update volume:
-            l2_ = _em_step_(proj, 1, volume, geom, options)
+                # Update volume:
+                l2_ = _em_step_(proj, 1, volume, geom, options, session = session)
             
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
             
-        l2.append(l2_)
+            l2.append(l2_)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
+    
     if options.get('l2_update'):   
 
          plt.figure(15)
@@ -107,7 +107,7 @@ def anyslice(array, index, dim):
     sl = [slice(None)] * array.ndim
     sl[dim] = index
       
-    return sl
+    return tuple(sl)
     
 def progress_bar(progress):
     """
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the geometry calibration routines. The CPU backend is used, so that they run without a GPU.
+"""
+import numpy
+import pytest
+
+import matplotlib
+matplotlib.use('Agg')
+
+from flexbox import flexData
+from flexbox import flexProject
+from flexbox import flexCompute
+
+@pytest.fixture(autouse = True)
+def cpu_backend():
+    
+    flexProject.set_backend('cpu')
+    yield
+    flexProject.set_backend(None)
+
+def _phantom_(size = 32, angles = 90, **shifts):
+    """
+    Balls spread over the volume and their projections. Shifts (e.g. axs_hrz) are applied to the geometry of the projections.
+    """
+    geometry = flexData.create_geometry(100., 100., 0.2, [0, 360])
+    geometry['img_pixel'] = 0.1
+    
+    z, y, x = numpy.mgrid[:size, :size, :size] - (size - 1) / 2
+    volume = numpy.zeros((size, size, size), dtype = 'float32')
+    
+    for c in numpy.random.default_rng(1).uniform(-0.3 * size, 0.3 * size, (12, 3)):
+        volume += ((z - c[0])**2 + (y - c[1])**2 + (x - c[2])**2) < (size / 8)**2
+        
+    projections = numpy.zeros((size, angles, size), dtype = 'float32')
+    flexProject.forwardproject(projections, volume, dict(geometry, **shifts))
+    
+    return projections, geometry
+    
+@pytest.mark.parametrize('axs_hrz', [0.23, -0.37])
+def test_estimate_rotation_center(axs_hrz):
+    """
+    Opposing projections give the rotation axis shift without reconstruction.
+    """
+    projections, geometry = _phantom_(axs_hrz = axs_hrz)
+    
+    assert flexCompute.estimate_rotation_center(projections, geometry) == pytest.approx(axs_hrz, abs = 0.01)
+    
+def test_estimate_rotation_center_no_pairs():
+    """
+    A scan without projections 180 degrees apart gives no estimate.
+    """
+    projections, geometry = _phantom_()
+    
+    assert flexCompute.estimate_rotation_center(projections, dict(geometry, theta_max = 90)) is None
+    
+@pytest.mark.parametrize('threads', [1, 2])
+def test_optimize_centre_slab(threads):
+    """
+    The slab search finds the rotation axis from a nearby guess, also when trials run in a thread pool.
+    """
+    projections, geometry = _phantom_(axs_hrz = 0.23)
+    
+    centre = flexCompute._optimize_centre_slab_(projections, geometry, 0.18, 2, slices = 8, threads = threads)
+    
+    assert centre == pytest.approx(0.23, abs = 0.02)
+
+def test_optimize_centre_slab_not_bracketed(capsys, monkeypatch):
+    """
+    If no trial is better than the others, the grid moves 10 times, then a warning is given and the best trial is used.
+    """
+    projections, geometry = _phantom_(axs_hrz = 0.23)
+    
+    monkeypatch.setattr(flexCompute, '_gradient_l2_', lambda vol: 0)
+    
+    centre = flexCompute._optimize_centre_slab_(projections, geometry, 0.18, 2, slices = 8, threads = 1)
+    
+    # The first trial wins every time: the grid of steps of 0.1 mm moves by 2 steps:
+    assert 'WARNING' in capsys.readouterr().out
+    assert centre == pytest.approx(0.18 - 2.2)
+    
+def test_calibrate_geometry(capsys):
+    """
+    The rotation axis and the detector tilt are found together, with a limited number of reconstructions.
+    """
+    projections, geometry = _phantom_(48, 60, axs_hrz = 0.05, det_rot = 0.02)
+    
+    geometry = flexCompute.calibrate_geometry(projections, geometry, keys = ['axs_hrz', 'det_rot'], subscales = [2, 1])
+    
+    total = int(capsys.readouterr().out.split('Total number of reconstructions:')[1].split()[0])
+    
+    assert geometry['axs_hrz'] == pytest.approx(0.05, abs = 0.005)
+    assert geometry['det_rot'] == pytest.approx(0.02, abs = 0.003)
+    assert total <= 50
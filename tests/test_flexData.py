@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of reading and writing data.
+"""
+import numpy
+import imageio
+import pytest
+
+from flexbox import flexData
+
+@pytest.mark.parametrize('astra', [False, True])
+def test_read_raw_corrupted_memmap(tmp_path, astra):
+    """
+    Corrupted files are dropped from a memmap stack in place: the result is a memmap of the good images.
+    """
+    images = [(numpy.arange(20).reshape(4, 5) + 100 * ii).astype('uint16') for ii in range(6)]
+    
+    for ii, image in enumerate(images):
+        imageio.imwrite(str(tmp_path / ('scan_%06u.tif' % ii)), image)
+        
+    (tmp_path / 'scan_000003.tif').write_bytes(b'corrupted')
+    
+    memmap = str(tmp_path / 'stack.bin')
+    data = flexData.read_raw(str(tmp_path), 'scan_', memmap = memmap, astra = astra)
+    
+    reference = numpy.array([images[ii] for ii in [0, 1, 2, 4, 5]], dtype = 'float32')
+    if astra: reference = reference[:, ::-1].transpose(1, 0, 2)
+    
+    assert isinstance(data, numpy.memmap)
+    assert numpy.array_equal(data, reference)
+    assert (tmp_path / 'stack.bin').stat().st_size == reference.nbytes
+    
+def test_read_chunked_negative(tmp_path):
+    """
+    Negative indexes and rows of read_chunked count from the end, like numpy indexing.
+    """
+    data = numpy.random.rand(10, 12, 7).astype('float32')
+    
+    filename = str(tmp_path / 'data.chunked')
+    flexData.write_chunked(filename, data, chunks = [4, 5, 7])
+    
+    assert numpy.array_equal(flexData.read_chunked(filename, index = -1)[0], data[:, [-1]])
+    assert numpy.array_equal(flexData.read_chunked(filename, index = [-3, 0, 6])[0], data[:, [-3, 0, 6]])
+    assert numpy.array_equal(flexData.read_chunked(filename, rows = [-3, None])[0], data[-3:])
+    
+    with pytest.raises(IndexError):
+        flexData.read_chunked(filename, index = [12])
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the reconstruction routines. The CPU backend is used, so that they run without a GPU.
+"""
+import numpy
+import pytest
+
+import matplotlib
+matplotlib.use('Agg')
+
+from flexbox import flexData
+from flexbox import flexProject
+
+@pytest.fixture(autouse = True)
+def cpu_backend():
+    
+    flexProject.set_backend('cpu')
+    yield
+    flexProject.set_backend(None)
+    
+def _phantom_(size = 24, det_pixel = 0.02, angles = 40):
+    """
+    Ball in the centre of the volume and its projections.
+    """
+    geometry = flexData.create_geometry(100., 100., det_pixel, [0, 360])
+    geometry['img_pixel'] = det_pixel / 2
+    
+    z, y, x = numpy.mgrid[:size, :size, :size] - (size - 1) / 2
+    volume = ((x**2 + y**2 + z**2) < (size / 3)**2).astype('float32')
+    
+    projections = numpy.zeros((size, angles, size), dtype = 'float32')
+    flexProject.forwardproject(projections, volume, geometry)
+    
+    return projections, volume, geometry
+    
+@pytest.mark.parametrize('block_number', [1, 4])
+def test_em_mass(block_number):
+    """
+    EM conserves the mass of the object, also with several blocks and small voxels.
+    """
+    projections, volume, geometry = _phantom_()
+    
+    vol = numpy.ones_like(volume)
+    flexProject.EM(projections, vol, geometry, 5, {'block_number':block_number, 'mode':'sequential'})
+    
+    assert vol.sum() / volume.sum() == pytest.approx(1, abs = 0.02)
+    
+def test_forward_large_voxels():
+    """
+    Voxels that project onto several pixels leave no gaps: every detector row covered by a cube is filled evenly.
+    """
+    geometry = flexData.create_geometry(100., 100., 0.02, [0, 360])
+    geometry['img_pixel'] = 0.01
+    geometry['anisotropy'] = [4, 4, 4]
+    
+    volume = numpy.ones((12, 12, 12), dtype = 'float32')
+    
+    projections = numpy.zeros((48, 4, 48), dtype = 'float32')
+    flexProject.forwardproject(projections, volume, geometry)
+    
+    # The cube of 0.48 mm is magnified 2 times, it covers the whole detector of 0.02 mm pixels:
+    rows = projections[8:40, 0, :].sum(1)
+    
+    assert rows.min() > 0.95 * rows.max()
+    assert numpy.abs(numpy.diff(projections[8:40, 0, 24])).max() < 0.05 * projections[24, 0, 24]
+    
+@pytest.mark.parametrize('method', ['sirt', 'fista', 'em', 'cgls'])
+def test_multiresolution(method):
+    """
+    Every method of the coarse-to-fine driver runs on subsampled levels and reconstructs the ball.
+    """
+    projections, volume, geometry = _phantom_()
+    
+    vol = numpy.zeros_like(volume)
+    flexProject.multiresolution(projections, vol, geometry, 3, method, {'block_number':4, 'mode':'sequential'}, levels = [2, 1])
+    
+    assert numpy.isfinite(vol).all()
+    assert numpy.corrcoef(vol.ravel(), volume.ravel())[0, 1] > 0.8
+    
+@pytest.mark.parametrize('method', ['sirt', 'em'])
+@pytest.mark.parametrize('roi_sample', [1, 2])
+def test_roi(method, roi_sample):
+    """
+    Iterative reconstruction of a region of interest is close to the same region of the full reconstruction,
+    also when the material outside of the region is estimated with coarse voxels.
+    """
+    projections, volume, geometry = _phantom_()
+    
+    solver = {'sirt': flexProject.SIRT, 'em': flexProject.EM}[method]
+    options = {'block_number':4, 'mode':'sequential', 'bounds':[0, 10]}
+    
+    full = numpy.zeros_like(volume)
+    solver(projections, full, geometry, 20, options)
+    
+    # Box of 8 voxels in the corner of the ball:
+    roi = [[-0.04, 0.04], [-0.08, 0], [0, 0.08]]
+    
+    vol = flexProject.init_volume(projections, geometry, roi)
+    solver(projections, vol, geometry, 20, dict(options, roi = roi, roi_sample = roi_sample))
+    
+    crop = full[8:16, 4:12, 12:20]
+    
+    assert numpy.abs(vol - crop).mean() < 0.1 * crop.mean()
+    
+def test_sensitivity_bricks():
+    """
+    Row and column sums don't depend on the active bricks of the session.
+    """
+    projections, volume, geometry = _phantom_()
+    
+    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
+    proj_geom = flexData.astra_proj_geom(geometry, projections.shape)
+    
+    with flexProject.ProjectorSession() as session:
+        
+        rows = session.sensitivity.rows(proj_geom, vol_geom, session).copy()
+        columns = session.sensitivity.columns(proj_geom, vol_geom, session).copy()
+        
+        session.sensitivity.clear()
+        
+        # Only the central brick is active:
+        mask = numpy.zeros_like(volume)
+        mask[8:16, 8:16, 8:16] = 1
+        
+        session.bricks = flexProject.BrickMap(volume.shape, size = 8)
+        session.bricks.restrict(mask)
+        
+        assert numpy.allclose(session.sensitivity.rows(proj_geom, vol_geom, session), rows)
+        assert numpy.allclose(session.sensitivity.columns(proj_geom, vol_geom, session), columns)
+        
+def test_bricks_recheck():
+    """
+    Bricks that stayed at zero are reactivated every recheck updates.
+    """
+    bricks = flexProject.BrickMap((4, 4, 4), size = 2, patience = 1, recheck = 3)
+    
+    volume = numpy.ones((4, 4, 4), dtype = 'float32')
+    volume[:2, :2, :2] = 0
+    
+    bricks.update(volume)
+    assert not bricks.active[0, 0, 0]
+    
+    bricks.update(volume)
+    bricks.update(volume)
+    assert bricks.active[0, 0, 0]
+    
+    # Still zero after the next update - inactive again:
+    bricks.update(volume)
+    assert not bricks.active[0, 0, 0]
+    
+class _FilteringBackend_(flexProject.CPUBackend):
+    """
+    CPU backend that filters at every FDK backprojection (backends without the filter-once path).
+    """
+    name = 'filtering'
+    prefilter = False
+    
+    def accumulate(self, algorithm, *args, **kwargs):
+        
+        if algorithm == 'FDK_FILTERED': algorithm = 'FDK_CUDA'
+        
+        flexProject.CPUBackend.accumulate(self, algorithm, *args, **kwargs)
+        
+@pytest.mark.parametrize('backend', ['cpu', _FilteringBackend_(), pytest.param('astra', marks = pytest.mark.skipif(not flexProject.astra.use_cuda(), reason = 'needs CUDA'))])
+def test_fdk_filtered(backend):
+    """
+    FDK of projections filtered once by fdk_filter is the same as FDK, also for subsampled data and ROI.
+    """
+    flexProject.set_backend(backend)
+    
+    projections, volume, geometry = _phantom_()
+    
+    for geometry_ in [geometry, dict(geometry, sample = [2, 2, 2], anisotropy = [2, 2, 2])]:
+        
+        roi = [[-0.04, 0.04], [-0.08, 0], [0, 0.08]]
+        
+        for roi_ in [None, roi]:
+            
+            vol = flexProject.init_volume(projections, geometry_, roi_)
+            flexProject.FDK(projections, vol, geometry_, roi = roi_)
+            
+            filtered, geometry_f = flexProject.fdk_filter(projections, geometry_)
+            
+            vol_f = numpy.zeros_like(vol)
+            flexProject.FDK(filtered, vol_f, geometry_f, roi = roi_, filtered = True)
+            
+            assert numpy.abs(vol_f - vol).max() < 1e-3 * numpy.abs(vol).max()
+            
+    # Normalization: the ball is reconstructed with values close to 1:
+    filtered, geometry_f = flexProject.fdk_filter(projections, geometry)
+    
+    vol = numpy.zeros_like(volume)
+    flexProject.FDK(filtered, vol, geometry_f, filtered = True)
+    
+    assert vol[10:14, 10:14, 10:14].mean() == pytest.approx(1, abs = 0.05)
+    
+def test_fdk_filtered_backend():
+    """
+    Projections filtered for one backend are not accepted by another one.
+    """
+    projections, volume, geometry = _phantom_()
+    
+    filtered, geometry_f = flexProject.fdk_filter(projections, geometry)
+    
+    flexProject.set_backend(_FilteringBackend_())
+    
+    with pytest.raises(ValueError):
+        flexProject.FDK(filtered, volume, geometry_f, filtered = True)
+        
+    with pytest.raises(ValueError):
+        flexProject.backproject(filtered, volume, geometry_f, 'FDK_FILTERED')